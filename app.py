@@ -1,21 +1,50 @@
 import os
 import re
+import atexit
 import time
-import json
 import difflib
 import uuid
+import random
+import shutil
+import hashlib
+import tempfile
+import mmap
+import shlex
+import fnmatch
+import bisect
+import heapq
+import subprocess
 import asyncio
+from collections import OrderedDict, deque
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Dict, Any, Optional, List
-from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_template
+from typing import Dict, Any, Optional, List, Tuple
+from weakref import WeakValueDictionary
+from functools import lru_cache, wraps
+from itertools import islice
+from threading import BoundedSemaphore, Event, Lock, Thread
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response, stream_template, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from threading import Lock
 import prometheus_client
 from prometheus_client import Counter, Histogram, Gauge
 import redis
 from dotenv import load_dotenv
 import requests  # type: ignore  # for mypy if types-requests is missing
+import orjson
+import msgspec
+try:
+    # Optional Rust port of difflib.unified_diff with identical output
+    from difflib_rs import unified_diff as _rs_unified_diff
+except ImportError:
+    _rs_unified_diff = None
+try:
+    # Optional C patience diff: anchors on unique lines, so large or repetitive files
+    # match faster and read better than with SequenceMatcher
+    from patiencediff import PatienceSequenceMatcher as _PatienceMatcher
+except ImportError:
+    _PatienceMatcher = None
 
 # Load environment variables
 load_dotenv()
@@ -27,8 +56,25 @@ MODEL_CALL_LATENCY = Histogram('ai_assistant_model_call_duration_seconds', 'Mode
 TOOL_CALL_SUCCESS = Counter('ai_assistant_tool_calls_total', 'Tool call success/failure', ['tool_name', 'status'])
 JSON_PARSE_FAILURES = Counter('ai_assistant_json_parse_failures_total', 'JSON parse failures')
 ACTIVE_SESSIONS = Gauge('ai_assistant_active_sessions', 'Active user sessions')
+CIRCUIT_BREAKER_STATE = Gauge('ai_assistant_circuit_breaker_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', ['model'])
+
+# jsonify and request.get_json go through orjson. Diff previews and file contents are
+# the largest payloads here, and orjson escapes long strings in C rather than in Python.
+class ORJSONProvider(DefaultJSONProvider):
+    OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.OPTIONS), mimetype=self.mimetype)
 
 app = Flask(__name__, static_url_path='', static_folder='static')
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Configuration
@@ -41,61 +87,346 @@ os.makedirs(WORKSPACE_DIR, exist_ok=True)
 os.makedirs(KNOWLEDGE_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
+# The app never changes its working directory, so resolve the project root (a getcwd()) once
+PROJECT_ROOT = os.path.abspath('.')
+
+# Root the file endpoints may read under. The default '/' keeps mounted drives browsable;
+# set FILE_ROOT to confine previews and raw reads to one tree.
+FILE_ROOT = os.path.realpath(os.getenv('FILE_ROOT', '/'))
+CHATS_ROOT = os.path.realpath(CHATS_DIR)
+
+@lru_cache(maxsize=1024)
+def safe_path(name: str, root: str = FILE_ROOT) -> str:
+    """Canonical path of name (relative to the working directory), raising ValueError if it leaves root.
+
+    realpath costs a readlink per component, so results are cached; a symlink retargeted
+    after its first lookup keeps its old resolution until it falls out of the cache.
+    """
+    path = os.path.realpath(name)
+    # With root '/' the prefix is root itself, not '//'
+    prefix = root if root.endswith(os.sep) else root + os.sep
+    if path != root and not path.startswith(prefix):
+        raise ValueError(f"'{name}' is outside {root}")
+    return path
+
+# Shared pool for overlapping blocking file reads
+IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='file-io')
+SEARCH_READ_WINDOW = 64
+SEARCH_BINARY_PROBE = 8192
+# Directories neither search nor its fallback descends into: VCS internals, dependency and cache trees
+SEARCH_SKIP_DIRS = frozenset({'.git', '.venv', 'node_modules', '__pycache__'})
+# search_files hands the scan to ripgrep when it is installed: it searches files in
+# parallel with a compiled regex engine instead of reading each one into Python
+RG_BINARY = shutil.which('rg')
+SEARCH_TIMEOUT = 30
+# Buffer size for file reads and writes. Python otherwise uses st_blksize, often only 4 KB,
+# which turns line-by-line reads of large files into many small read() calls.
+IO_BUF = 1 << 17
+# Files at least this large are decoded from an mmap instead of a read() into a bytes copy
+MMAP_MIN_SIZE = 1 << 16
+
 # Redis for rate limiting and session management
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-
-# Session state for current directory
-session_paths: Dict[str, str] = {}
+# A bounded, blocking pool: every request, model-call and background thread shares it, and
+# when it runs dry callers wait up to 2s for a free connection instead of opening more.
+# Timeouts keep an unreachable Redis from stalling requests; all callers treat RedisError
+# as "Redis unavailable" and carry on without it.
+redis_pool = redis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=64, timeout=2,
+    socket_connect_timeout=2, socket_timeout=5, decode_responses=True)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# One pooled HTTP session for all model calls so TLS connections to OpenRouter are reused.
+# Every call goes to the one host, so a single pool is enough; it keeps up to 100 idle
+# connections, enough for every open stream plus its hedge. Failed calls are not retried
+# here, since the fallback models and hedging already cover that.
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=100, max_retries=0))
+# Connect just past the 3s TCP SYN retransmit so a single lost SYN is not a failure;
+# the read timeout bounds each wait for the next streamed chunk, not the whole reply
+MODEL_TIMEOUT = (3.05, 60)
+
+# Model-call rate limiting: a token bucket shared by every worker. The Lua script
+# refills from the Redis clock and reserves a token in a single round-trip, returning
+# how long the caller has to wait (in ms) before its reservation is due.
+MODEL_RATE_LIMIT_BURST = int(os.getenv('MODEL_RATE_LIMIT_BURST', '4'))
+MODEL_RATE_LIMIT_PER_MINUTE = float(os.getenv('MODEL_RATE_LIMIT_PER_MINUTE', '4'))
+# A caller whose reservation is further out than this gets an error instead of
+# parking its request thread; the token is handed back for whoever comes next
+MODEL_RATE_LIMIT_MAX_WAIT = float(os.getenv('MODEL_RATE_LIMIT_MAX_WAIT', '30'))
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate) - cost
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate))
+if tokens >= 0 then
+  return 0
+end
+return math.ceil(-tokens / rate)
+"""
 
-# Circuit breaker for model calls
+class TokenBucket:
+    def __init__(self, key: str, capacity: int, refill_per_second: float):
+        self.key = key
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._script = redis_client.register_script(TOKEN_BUCKET_LUA)
+        # In-process bucket used when Redis is unreachable
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self, cost: int = 1) -> float:
+        """Take `cost` tokens and return the seconds to wait before they may be used."""
+        try:
+            wait_ms = self._script(keys=[self.key], args=[self.capacity, self.refill_per_second / 1000, cost])
+            return int(wait_ms) / 1000
+        except redis.RedisError:
+            return self._reserve_local(cost)
+
+    def refund(self, cost: int = 1):
+        """Give back tokens from a reservation that will not be used."""
+        self.reserve(-cost)
+
+    def _reserve_local(self, cost: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second) - cost
+            self._updated = now
+            return max(0.0, -self._tokens / self.refill_per_second)
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5'))
+CIRCUIT_BREAKER_RECOVERY_TIMEOUT = int(os.getenv('CIRCUIT_BREAKER_RECOVERY_TIMEOUT', '60'))
+
+# Hedged model calls: when the models in flight have not answered after
+# MODEL_HEDGE_DELAY seconds, the next fallback model is started alongside them.
+MODEL_HEDGE_DELAY = float(os.getenv('MODEL_HEDGE_DELAY', '2'))
+MODEL_HEDGE_FANOUT = 2
+MODEL_CALL_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix='model-call')
+
+# Transient upstream failures (timeouts, dropped connections, 429/5xx) are retried on the
+# same model with full-jitter exponential backoff before the fallback models take over.
+# A 429 is retried no sooner than its Retry-After, as long as that is within the cap.
+MODEL_RETRY_ATTEMPTS = 3
+MODEL_RETRY_BACKOFF_BASE = 0.5
+MODEL_RETRY_BACKOFF_CAP = 8.0
+MODEL_RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+    """Seconds to sleep before retry number `attempt` (1-based), or None to stop retrying."""
+    delay = random.uniform(0, min(MODEL_RETRY_BACKOFF_CAP, MODEL_RETRY_BACKOFF_BASE * 2 ** (attempt - 1)))
+    if retry_after:
+        try:
+            wanted = float(retry_after)
+        except ValueError:
+            return delay  # An HTTP-date; not worth parsing for an upstream that sends seconds
+        if wanted > MODEL_RETRY_BACKOFF_CAP:
+            return None
+        delay = max(delay, wanted)
+    return delay
+
+def _close_model_response(future):
+    # The losing side of a hedge may still answer; release its connection
+    response = future.result()
+    if response is not None:
+        response.close()
+
+# Circuit breaker for model calls. The hot path takes no lock: state changes are single
+# attribute stores, and a race between two threads at worst counts one failure twice.
 class CircuitBreaker:
-    def __init__(self, failure_threshold=5, recovery_timeout=60):
+    STATE_VALUES = {'CLOSED': 0, 'HALF_OPEN': 1, 'OPEN': 2}
+
+    def __init__(self, failure_threshold=5, recovery_timeout=60, name: Optional[str] = None):
         self.failure_threshold = failure_threshold
         self.recovery_timeout = recovery_timeout
         self.failure_count = 0
         self.last_failure_time = 0
         self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
+        # Named breakers report their state, labelled by model
+        self._gauge = CIRCUIT_BREAKER_STATE.labels(model=name) if name else None
+        if self._gauge is not None:
+            self._gauge.set(0)
+
+    def _transition(self, state: str):
+        self.state = state
+        if self._gauge is not None:
+            self._gauge.set(self.STATE_VALUES[state])
     
     def call(self, func, *args, **kwargs):
         if self.state == 'OPEN':
-            if time.time() - self.last_failure_time > self.recovery_timeout:
-                self.state = 'HALF_OPEN'
+            if time.monotonic() - self.last_failure_time > self.recovery_timeout:
+                self._transition('HALF_OPEN')
             else:
                 raise Exception("Circuit breaker is OPEN")
         
         try:
             result = func(*args, **kwargs)
             if self.state == 'HALF_OPEN':
-                self.state = 'CLOSED'
+                self._transition('CLOSED')
+            # Only consecutive failures trip the breaker; skip the store when there is nothing to reset
+            if self.failure_count:
                 self.failure_count = 0
             return result
         except Exception as e:
             self.failure_count += 1
-            self.last_failure_time = time.time()
-            if self.failure_count >= self.failure_threshold:
-                self.state = 'OPEN'
+            self.last_failure_time = time.monotonic()
+            if self.failure_count >= self.failure_threshold and self.state != 'OPEN':
+                self._transition('OPEN')
             raise e
 
-# Structured logging with request correlation
+# Structured logging with request correlation. Entries are queued and written in
+# batches by a background thread through one persistent, buffered file handle, and
+# each batch is mirrored to a capped Redis stream in one unconfirmed pipeline. The
+# queue is bounded and drops its oldest entry when full, so log() never blocks.
 class StructuredLogger:
-    def __init__(self):
+    def __init__(self, batch_size: int = 256, flush_interval: float = 0.2, max_queue: int = 10_000,
+                 redis_stream: str = 'logs:app', stream_maxlen: int = 100_000):
         self.log_file = 'logs/app.log'
         os.makedirs('logs', exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.redis_stream = redis_stream
+        self.stream_maxlen = stream_maxlen
+        self.dropped = 0
+        # Ring buffer: append and popleft are single atomic calls under the GIL, so the
+        # request path takes no lock and never wakes the writer; a full ring drops its oldest entry
+        self._ring: deque = deque(maxlen=max_queue)
+        self._fp = open(self.log_file, 'ab', buffering=1 << 16)
+        self._write_lock = Lock()
+        Thread(target=self._run, name='log-writer', daemon=True).start()
+        atexit.register(self._drain)
     
     def log(self, level: str, message: str, request_id: Optional[str] = None, **kwargs):
+        # The timestamp stays a datetime; the writer thread serializes it (orjson
+        # emits the same ISO 8601 text as isoformat())
         log_entry = {
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': datetime.utcnow(),
             'level': level,
             'message': message,
             'request_id': request_id,
             **kwargs
         }
-        with open(self.log_file, 'a') as f:
-            f.write(json.dumps(log_entry) + '\n')
+        if len(self._ring) == self._ring.maxlen:
+            self.dropped += 1
+        self._ring.append(log_entry)
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        batch: List[Dict[str, Any]] = []
+        popleft = self._ring.popleft
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(popleft())
+            except IndexError:
+                break
+        return batch
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        lines = [orjson.dumps(entry, default=str, option=orjson.OPT_APPEND_NEWLINE) for entry in batch]
+        with self._write_lock:
+            self._fp.writelines(lines)
+            self._fp.flush()
+        self._publish(lines)
+
+    def _publish(self, lines: List[bytes]):
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for line in lines:
+                pipe.xadd(self.redis_stream, {'entry': line}, maxlen=self.stream_maxlen, approximate=True)
+            pipe.execute(raise_on_error=False)
+        except redis.RedisError:
+            pass  # The file is the record of truth; the stream is best-effort
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            if len(batch) < self.batch_size:
+                time.sleep(self.flush_interval)
+
+    def _drain(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+            self._write(batch)
 
 logger = StructuredLogger()
 
+# Metric updates. Prometheus is updated in-process right away; the same deltas are
+# aggregated locally and mirrored to Redis in one pipeline per flush so totals can be
+# summed across gunicorn workers without a Redis round-trip per request.
+class MetricsBuffer:
+    def __init__(self, redis_key: str = 'metrics:counters', flush_interval: float = 0.1):
+        self.redis_key = redis_key
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, float] = {}
+        self._lock = Lock()
+        # (metric, suffixes, labels) -> (labelled child, Redis field names). Label sets are
+        # few and fixed, so after warm-up each update is one dict hit and the child's inc/observe.
+        self._handles: Dict[tuple, tuple] = {}
+        Thread(target=self._run, name='metrics-flusher', daemon=True).start()
+
+    @staticmethod
+    def _field(metric, suffix: str, labels: Dict[str, str]) -> str:
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        return f"{metric._name}{suffix}{{{label_str}}}"
+
+    def _handle(self, metric, suffixes: tuple, labels: Dict[str, str]) -> tuple:
+        key = (metric, suffixes, tuple(labels.items()))
+        handle = self._handles.get(key)
+        if handle is None:
+            child = metric.labels(**labels) if labels else metric
+            handle = (child, tuple(self._field(metric, suffix, labels) for suffix in suffixes))
+            self._handles[key] = handle
+        return handle
+
+    def _add(self, field: str, amount: float):
+        with self._lock:
+            self._pending[field] = self._pending.get(field, 0) + amount
+
+    def inc(self, metric, amount: float = 1, **labels):
+        child, (total_field,) = self._handle(metric, ('_total',), labels)
+        child.inc(amount)
+        self._add(total_field, amount)
+
+    def observe(self, metric, value: float, **labels):
+        child, (count_field, sum_field) = self._handle(metric, ('_count', '_sum'), labels)
+        child.observe(value)
+        with self._lock:
+            self._pending[count_field] = self._pending.get(count_field, 0) + 1
+            self._pending[sum_field] = self._pending.get(sum_field, 0) + value
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for field, amount in pending.items():
+                pipe.hincrbyfloat(self.redis_key, field, amount)
+            pipe.execute()
+        except redis.RedisError:
+            # Keep the deltas for the next attempt; they are aggregated, so this stays bounded
+            for field, amount in pending.items():
+                self._add(field, amount)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+metrics_buffer = MetricsBuffer()
+
 # Request correlation middleware
 def correlate_request():
     request_id = request.headers.get('X-Request-ID') or str(uuid.uuid4())
@@ -106,31 +437,203 @@ def log_request(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         request_id = correlate_request()
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         try:
             response = f(*args, **kwargs)
-            duration = time.time() - start_time
-            REQUEST_COUNT.labels(endpoint=f.__name__, status='success').inc()
-            REQUEST_LATENCY.labels(endpoint=f.__name__).observe(duration)
+            duration = time.perf_counter() - start_time
+            metrics_buffer.inc(REQUEST_COUNT, endpoint=f.__name__, status='success')
+            metrics_buffer.observe(REQUEST_LATENCY, duration, endpoint=f.__name__)
             logger.log('INFO', f'Request completed', request_id, 
                       endpoint=f.__name__, duration=duration)
             return response
         except Exception as e:
-            duration = time.time() - start_time
-            REQUEST_COUNT.labels(endpoint=f.__name__, status='error').inc()
-            REQUEST_LATENCY.labels(endpoint=f.__name__).observe(duration)
+            duration = time.perf_counter() - start_time
+            metrics_buffer.inc(REQUEST_COUNT, endpoint=f.__name__, status='error')
+            metrics_buffer.observe(REQUEST_LATENCY, duration, endpoint=f.__name__)
             logger.log('ERROR', f'Request failed: {str(e)}', request_id,
                       endpoint=f.__name__, duration=duration, error=str(e))
             raise
     return decorated_function
 
-# Enhanced AI Assistant with multi-model orchestration
+# Per-session conversation history, mirrored to Redis so it survives worker restarts
+class ConversationState:
+    def __init__(self, session_id: str, messages: Optional[List[Dict[str, Any]]] = None, cwd: Optional[str] = None):
+        self.session_id = session_id
+        self.messages: List[Dict[str, Any]] = messages or []
+        # Directory the file tree is browsing for this session; always absolute, since
+        # set_cwd stores abspath results and the default is the resolved project root
+        self.cwd = cwd or PROJECT_ROOT
+        self._cwd_lock = Lock()
+        # Transcript file saved from this session: its name and (length, digest) of the last
+        # save, as recorded in Redis so every worker extends the same file (these are the
+        # fallback while Redis is down), and this process's pending write of it.
+        self.chat_file: Optional[str] = None
+        self.chat_saved = (0, '')
+        self.chat_write: Optional[Future] = None
+        self._chat_lock = Lock()
+        # Prompt-formatted history lines, kept in step with messages so each turn formats once
+        self.history_parts: List[str] = [self._format(m) for m in self.messages]
+
+    @staticmethod
+    def _format(message: Dict[str, Any]) -> str:
+        return f"**{message['role'].capitalize()}**: {message['content']}"
+
+    @staticmethod
+    def redis_key_for(session_id: str) -> str:
+        return f"session:{session_id}:messages"
+
+    @staticmethod
+    def cwd_key_for(session_id: str) -> str:
+        return f"session:{session_id}:cwd"
+
+    @staticmethod
+    def chat_key_for(session_id: str) -> str:
+        return f"session:{session_id}:chat"
+
+    @property
+    def redis_key(self) -> str:
+        return self.redis_key_for(self.session_id)
+
+    @classmethod
+    def queue_load(cls, pipe, session_id: str):
+        pipe.lrange(cls.redis_key_for(session_id), 0, -1)
+        pipe.get(cls.cwd_key_for(session_id))
+
+    @classmethod
+    def from_stored(cls, session_id: str, stored: List[str], cwd: Optional[str]) -> 'ConversationState':
+        return cls(session_id, [orjson.loads(m) for m in stored], cwd)
+
+    @classmethod
+    def load(cls, session_id: str) -> 'ConversationState':
+        pipe = redis_client.pipeline(transaction=False)
+        cls.queue_load(pipe, session_id)
+        try:
+            stored, cwd = pipe.execute()
+        except redis.RedisError as e:
+            logger.log('WARNING', 'Failed to load session history', None, session_id=session_id, error=str(e))
+            stored, cwd = [], None
+        return cls.from_stored(session_id, stored, cwd)
+
+    def set_cwd(self, path: str):
+        # Readers see the attribute atomically. The lock orders concurrent changes so the
+        # directory Redis keeps is the one this process ends up with, not an earlier one.
+        with self._cwd_lock:
+            self.cwd = path
+            try:
+                redis_client.set(self.cwd_key_for(self.session_id), path)
+            except redis.RedisError as e:
+                logger.log('WARNING', 'Failed to persist session directory', None, session_id=self.session_id, error=str(e))
+
+    def saved_chat(self) -> Tuple[Optional[str], int, str]:
+        """(file, length, digest) of the session's last chat save, by whichever worker made it."""
+        try:
+            stored = redis_client.hgetall(self.chat_key_for(self.session_id))
+        except redis.RedisError as e:
+            logger.log('WARNING', 'Failed to load saved chat', None, session_id=self.session_id, error=str(e))
+            stored = None
+        if stored:
+            # decode_responses makes these str already; str() is for the type checker
+            return str(stored['file']), int(stored['length']), str(stored['digest'])
+        return (self.chat_file, *self.chat_saved)
+
+    def record_chat(self, fname: str, length: int, digest: str):
+        self.chat_file, self.chat_saved = fname, (length, digest)
+        try:
+            redis_client.hset(self.chat_key_for(self.session_id),
+                              mapping={'file': fname, 'length': length, 'digest': digest})
+        except redis.RedisError as e:
+            logger.log('WARNING', 'Failed to persist saved chat', None, session_id=self.session_id, error=str(e))
+
+    def append(self, message: Dict[str, Any]):
+        self.messages.append(message)
+        self.history_parts.append(self._format(message))
+        try:
+            redis_client.rpush(self.redis_key, orjson.dumps(message))
+        except redis.RedisError as e:
+            logger.log('WARNING', 'Failed to persist session message', None, session_id=self.session_id, error=str(e))
+
+PROMPT_TAIL = """
+
+**Your Task:**
+Based on the conversation, provide a direct answer or call a tool if necessary. When you need to use a tool, respond with a JSON object inside a ```json code block.
+"""
+
+# Tool schema advertised to the model; built once at import and shared by every request
+TOOLS_DEFINITION = [
+    {"type": "function", "function": {"name": "list_files", "description": "Lists all files in a given directory.", "parameters": {"type": "object", "properties": {"directory": {"type": "string", "description": "Directory to list files from (defaults to current directory '.')"}}, "required": []}}},
+    {"type": "function", "function": {"name": "read_file", "description": "Reads the content of a specified file, optionally from a start line to an end line.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to read."}, "start_line": {"type": "integer", "description": "Optional. The line number to start reading from."}, "end_line": {"type": "integer", "description": "Optional. The line number to stop reading at."}}, "required": ["filename"]}}},
+    {"type": "function", "function": {"name": "write_file", "description": "Creates or overwrites a file with new content. If content is a dictionary or list, it's saved as a JSON file.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to write to."}, "content": {"type": "any", "description": "The content to write into the file (can be a string, or a JSON object/dict)."}}, "required": ["filename", "content"]}}},
+    {"type": "function", "function": {"name": "delete_file", "description": "Deletes a specified file from the directory.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to delete."}}, "required": ["filename"]}}},
+    {"type": "function", "function": {"name": "create_directory", "description": "Creates a new directory (folder). If the directory already exists, it will do nothing and report success. To create nested directories, provide the full path (e.g., 'parent/child').", "parameters": {"type": "object", "properties": {"directory_name": {"type": "string", "description": "The name or path of the directory to create."}}, "required": ["directory_name"]}}},
+    {"type": "function", "function": {"name": "insert_at_line", "description": "Inserts a block of code at a specific line number. This is the preferred way to add new code.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to modify."}, "code_to_insert": {"type": "string", "description": "The block of code to add."}, "line_number": {"type": "integer", "description": "The line number at which to insert the code."}}, "required": ["filename", "code_to_insert", "line_number"]}}},
+    {"type": "function", "function": {"name": "replace_code", "description": "Replaces an *exact* block of existing code with a new block. To use this effectively, first `read_file` to copy the precise `old_code` block you want to replace. The `new_code` will be automatically indented to match the old code's level.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to modify."}, "old_code": {"type": "string", "description": "The exact string or code block to be replaced."}, "new_code": {"type": "string", "description": "The new string or code block to replace the old one."}}, "required": ["filename", "old_code", "new_code"]}}},
+    {"type": "function", "function": {"name": "search_files", "description": "Search for text in files using grep-like functionality with optional regex support.", "parameters": {"type": "object", "properties": {"pattern": {"type": "string", "description": "The search pattern (supports regex)."}, "directory": {"type": "string", "description": "Directory to search in (default: current directory)."}, "file_pattern": {"type": "string", "description": "File pattern to search in (e.g., '*.py', '*.js')."}}, "required": ["pattern"]}}},
+    {"type": "function", "function": {"name": "run_command", "description": "Run a command in a sandboxed environment. Only safe commands are allowed.", "parameters": {"type": "object", "properties": {"command": {"type": "string", "description": "The command to run."}}, "required": ["command"]}}},
+]
+# The tools schema never changes, so serialize it for the prompt once
+TOOLS_JSON = orjson.dumps([tool['function'] for tool in TOOLS_DEFINITION], option=orjson.OPT_INDENT_2).decode('utf-8')
+
+# Tools that modify the filesystem and need explicit user approval
+DANGEROUS_TOOLS = frozenset({"write_file", "delete_file", "create_directory", "replace_code", "insert_at_line"})
+# Executables run_command may launch, matched on the first token of the command
+SAFE_COMMANDS = frozenset({'python', 'python3', 'pip', 'npm', 'node', 'git', 'ls', 'cat', 'head', 'tail'})
+
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '1000'))
+
+# Bounded LRU of hot sessions. Every message is already mirrored to Redis on append,
+# so evicting the least recently used session only drops the in-process copy.
+class SessionStore:
+    def __init__(self, capacity: int = SESSION_CACHE_SIZE):
+        self.capacity = capacity
+        self._sessions: 'OrderedDict[str, ConversationState]' = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def get(self, session_id: str) -> ConversationState:
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                return state
+        # Load outside the lock so a slow Redis read does not stall other sessions
+        return self._insert(ConversationState.load(session_id))
+
+    def preload(self, session_ids: List[str]):
+        """Warm several cold sessions with a single pipelined Redis round-trip."""
+        missing = [sid for sid in session_ids if sid not in self._sessions]
+        if not missing:
+            return
+        pipe = redis_client.pipeline(transaction=False)
+        for sid in missing:
+            ConversationState.queue_load(pipe, sid)
+        try:
+            results = pipe.execute()
+        except redis.RedisError as e:
+            logger.log('WARNING', 'Failed to preload sessions', None, count=len(missing), error=str(e))
+            return
+        for i, sid in enumerate(missing):
+            self._insert(ConversationState.from_stored(sid, results[2 * i], results[2 * i + 1]))
+
+    def _insert(self, state: ConversationState) -> ConversationState:
+        with self._lock:
+            # Another request may have loaded the same session meanwhile; keep the first copy
+            existing = self._sessions.setdefault(state.session_id, state)
+            self._sessions.move_to_end(state.session_id)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+            return existing
+
+# Enhanced AI Assistant with multi-model orchestration. Holds only shared,
+# session-independent configuration; conversation state lives in session_memory.
 class EnhancedAIAssistant:
     def __init__(self):
-        self.messages = [{
-            "role": "system",
-            "content": """You are an expert AI programmer and universal code assistant. Your goal is to help users by writing and editing code in any language. Follow these rules strictly:
+        self.system_prompt = """You are an expert AI programmer and universal code assistant. Your goal is to help users by writing and editing code in any language. Follow these rules strictly:
 
 1. **Match Indentation Style**: When editing a file, you MUST detect and match the existing indentation style.
 2. **Use Precise Tools**: To add new code, use `insert_at_line` with a specific line number. To modify existing code, use `replace_code` by first reading the exact block to be replaced.
@@ -156,7 +659,16 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
   }
 }
 ```"""
-        }]
+        self._prompt_head = f"""**System Prompt:**
+{self.system_prompt}
+
+**Available Tools:**
+```json
+{TOOLS_JSON}
+```
+
+**Conversation History:**
+"""
         self.tools = self._get_tools_definition()
         self.available_functions = {
             "list_files": self.list_files,
@@ -174,27 +686,157 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
             'openrouter/anthropic/claude-3.5-sonnet',
             'openrouter/meta-llama/llama-3.1-8b-instruct',
         ]
-        self.last_request_time = 0
-        self.request_interval = 16
-        self.circuit_breaker = CircuitBreaker()
-        self.session_memory = {}
+        self.rate_limiter = TokenBucket('ratelimit:openrouter', MODEL_RATE_LIMIT_BURST, MODEL_RATE_LIMIT_PER_MINUTE / 60)
+        # One breaker per model so a failing model does not lock out the healthy ones
+        self._cb: Dict[str, CircuitBreaker] = {}
+        self.hedge_delay = MODEL_HEDGE_DELAY
+        self.session_memory = SessionStore()
+
+    def get_session(self, session_id: str) -> ConversationState:
+        return self.session_memory.get(session_id)
     
     def _get_tools_definition(self):
-        return [
-            {"type": "function", "function": {"name": "list_files", "description": "Lists all files in a given directory.", "parameters": {"type": "object", "properties": {"directory": {"type": "string", "description": "Directory to list files from (defaults to current directory '.')"}}, "required": []}}},
-            {"type": "function", "function": {"name": "read_file", "description": "Reads the content of a specified file, optionally from a start line to an end line.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to read."}, "start_line": {"type": "integer", "description": "Optional. The line number to start reading from."}, "end_line": {"type": "integer", "description": "Optional. The line number to stop reading at."}}, "required": ["filename"]}}},
-            {"type": "function", "function": {"name": "write_file", "description": "Creates or overwrites a file with new content. If content is a dictionary or list, it's saved as a JSON file.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to write to."}, "content": {"type": "any", "description": "The content to write into the file (can be a string, or a JSON object/dict)."}}, "required": ["filename", "content"]}}},
-            {"type": "function", "function": {"name": "delete_file", "description": "Deletes a specified file from the directory.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to delete."}}, "required": ["filename"]}}},
-            {"type": "function", "function": {"name": "create_directory", "description": "Creates a new directory (folder). If the directory already exists, it will do nothing and report success. To create nested directories, provide the full path (e.g., 'parent/child').", "parameters": {"type": "object", "properties": {"directory_name": {"type": "string", "description": "The name or path of the directory to create."}}, "required": ["directory_name"]}}},
-            {"type": "function", "function": {"name": "insert_at_line", "description": "Inserts a block of code at a specific line number. This is the preferred way to add new code.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to modify."}, "code_to_insert": {"type": "string", "description": "The block of code to add."}, "line_number": {"type": "integer", "description": "The line number at which to insert the code."}}, "required": ["filename", "code_to_insert", "line_number"]}}},
-            {"type": "function", "function": {"name": "replace_code", "description": "Replaces an *exact* block of existing code with a new block. To use this effectively, first `read_file` to copy the precise `old_code` block you want to replace. The `new_code` will be automatically indented to match the old code's level.", "parameters": {"type": "object", "properties": {"filename": {"type": "string", "description": "The name of the file to modify."}, "old_code": {"type": "string", "description": "The exact string or code block to be replaced."}, "new_code": {"type": "string", "description": "The new string or code block to replace the old one."}}, "required": ["filename", "old_code", "new_code"]}}},
-            {"type": "function", "function": {"name": "search_files", "description": "Search for text in files using grep-like functionality with optional regex support.", "parameters": {"type": "object", "properties": {"pattern": {"type": "string", "description": "The search pattern (supports regex)."}, "directory": {"type": "string", "description": "Directory to search in (default: current directory)."}, "file_pattern": {"type": "string", "description": "File pattern to search in (e.g., '*.py', '*.js')."}}, "required": ["pattern"]}}},
-            {"type": "function", "function": {"name": "run_command", "description": "Run a command in a sandboxed environment. Only safe commands are allowed.", "parameters": {"type": "object", "properties": {"command": {"type": "string", "description": "The command to run."}}, "required": ["command"]}}},
-        ]
+        return TOOLS_DEFINITION
+
+    @staticmethod
+    def _get_indentation(s: str) -> str:
+        # lstrip scans in C; only spaces and tabs count, so a blank line has no indent
+        return s[:len(s) - len(s.lstrip(' \t'))]
+
+    @staticmethod
+    def _indent_block(code: str, indent: str) -> str:
+        """Prefix every line of code with indent using a single join."""
+        code_lines = code.splitlines()
+        return indent + ("\n" + indent).join(code_lines) if code_lines else ""
+
+    @staticmethod
+    def _replacement_code(old_code: str, new_code: str) -> str:
+        """The text replace_code puts in place of each occurrence of old_code; the preview shows the same.
+
+        new_code is indented like old_code's first line, and keeps its final line break so
+        replacing whole lines does not join the last one onto the line after it.
+        """
+        base_indent = EnhancedAIAssistant._get_indentation(old_code.splitlines()[0])
+        replacement = EnhancedAIAssistant._indent_block(new_code, base_indent)
+        return replacement + '\n' if replacement and new_code.endswith('\n') else replacement
+
+    def _backup_file(self, filename, move=False) -> bool:
+        """Back up filename. With move=True a regular file may be renamed into the backup
+        instead, which is then also its removal; returns True if that happened."""
+        if os.path.exists(filename):
+            backup_path = os.path.join(BACKUP_DIR, f"{filename}_{int(time.time())}.bak")
+            os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+            if move and os.path.isfile(filename) and not os.path.islink(filename):
+                try:
+                    os.rename(filename, backup_path)
+                    return True
+                except OSError:
+                    pass  # EXDEV: the backups live on another filesystem
+            # A hardlink keeps the old inode alive at no I/O cost. This is only safe because
+            # every writer that backs up first replaces the file rather than rewriting it in place.
+            try:
+                os.link(filename, backup_path)
+                return False
+            except OSError:
+                pass  # EXDEV, EPERM, an existing backup from the same second, ...
+            self._copy_backup(filename, backup_path)
+        return False
+
+    @staticmethod
+    def _has_content(filename, data) -> bool:
+        """True if filename already holds exactly data; the size is compared before any read."""
+        try:
+            if not isinstance(data, bytes) or os.path.getsize(filename) != len(data):
+                return False
+            with open(filename, 'rb', buffering=IO_BUF) as f:
+                return f.read() == data
+        except OSError:
+            return False
+
+    @staticmethod
+    def _copy_backup(filename, backup_path):
+        """Copy filename to backup_path, storing each distinct content only once.
+
+        Copies land in a content-addressed store under BACKUP_DIR, named by their blake2b
+        digest, and the backup is a hardlink to the stored copy; backing up an unchanged
+        file again adds a name, not another copy. The file is hashed while it is copied,
+        so it is read once whether or not its content was already stored.
+        """
+        objects_dir = os.path.join(BACKUP_DIR, '.objects')
+        os.makedirs(objects_dir, exist_ok=True)
+        digest = hashlib.blake2b(digest_size=16)
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir)
+        try:
+            with open(filename, 'rb', buffering=0) as src, os.fdopen(fd, 'wb', buffering=IO_BUF) as dst:
+                buf = bytearray(IO_BUF)
+                view = memoryview(buf)
+                while True:
+                    n = src.readinto(buf)
+                    if not n:
+                        break
+                    digest.update(view[:n])
+                    dst.write(view[:n])
+            object_path = os.path.join(objects_dir, digest.hexdigest())
+            if os.path.exists(object_path):
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if os.path.lexists(backup_path):
+            os.unlink(backup_path)  # A backup from earlier in the same second
+        try:
+            os.link(object_path, backup_path)
+        except OSError:
+            shutil.copyfile(object_path, backup_path)  # Backups on a filesystem without hardlinks
+
+    def _replace_file(self, filename, content):
+        """Write content (str or bytes) to a new inode and rename it over filename."""
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename) + '.')
+        try:
+            with (os.fdopen(fd, 'wb', buffering=IO_BUF) if isinstance(content, bytes) else os.fdopen(fd, 'w', encoding='utf-8', buffering=IO_BUF)) as f:
+                f.write(content)
+            if os.path.exists(filename):
+                shutil.copymode(filename, tmp_path)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
-    def _get_indentation(self, s: str) -> str:
-        match = re.match(r'^(\s*)', s)
-        return match.group(1) if match else ""
+    @staticmethod
+    def _map_file(f, size: int):
+        # Read-only view for C-level find(); mmap cannot map an empty file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else nullcontext(b'')
+
+    def _splice_file(self, filename, f, edits):
+        """Apply sorted (offset, old_length, new_bytes) edits to the file open as f.
+
+        Only the bytes from the first edit onward are rewritten, so an append is a single
+        write. A file with other hardlinks is written to a new inode instead, leaving the
+        other names with the old content.
+        """
+        fd = f.fileno()
+        hardlinked = os.fstat(fd).st_nlink > 1
+        base = 0 if hardlinked else edits[0][0]
+        f.seek(base)
+        rest = f.read()
+        pieces, pos = [], base
+        for offset, old_length, new_bytes in edits:
+            pieces.append(rest[pos - base:offset - base])
+            pieces.append(new_bytes)
+            pos = offset + old_length
+        pieces.append(rest[pos - base:])
+        data = b''.join(pieces)
+        if hardlinked:
+            self._replace_file(filename, data)
+            return
+        os.pwrite(fd, data, base)
+        os.ftruncate(fd, base + len(data))
+        # The inode is kept, and the edit may land in the same mtime tick at the same size
+        file_text_cache.discard(os.path.realpath(filename))
 
     def list_files(self, directory="."):
         try:
@@ -215,17 +857,21 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
 
     def read_file(self, filename, start_line=None, end_line=None):
         try:
-            with open(filename, 'r', encoding='utf-8') as f: 
-                lines = f.readlines()
             if start_line is None and end_line is None:
-                content = "".join(lines)
+                with open(filename, 'r', encoding='utf-8', buffering=IO_BUF) as f:
+                    content = f.read()
                 return f"Content of '{filename}':\n---\n{content}\n---"
             start_index = (int(start_line) - 1) if start_line else 0
-            end_index = int(end_line) if end_line else len(lines)
+            end_index = int(end_line) if end_line else None
             if start_index < 0: 
                 start_index = 0
-            selected_lines = lines[start_index:end_index]
-            content = "".join(selected_lines)
+            with open(filename, 'r', encoding='utf-8', buffering=IO_BUF) as f:
+                if end_index is not None and end_index >= 0:
+                    # Stop reading at end_line instead of loading the rest of the file
+                    content = "".join(islice(f, start_index, max(end_index, start_index)))
+                    return f"Content of '{filename}' from line {start_line or 1} to {end_line}:\n---\n{content}\n---"
+                lines = f.readlines()
+            content = "".join(lines[start_index:end_index])
             return f"Content of '{filename}' from line {start_line or 1} to {end_line or len(lines)}:\n---\n{content}\n---"
         except FileNotFoundError: 
             return f"Error: File '{filename}' not found."
@@ -234,116 +880,134 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
 
     def write_file(self, filename, content):
         try:
-            # Create backup before writing
-            if os.path.exists(filename):
-                backup_path = os.path.join(BACKUP_DIR, f"{filename}_{int(time.time())}.bak")
-                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
-                with open(filename, 'r', encoding='utf-8') as src:
-                    with open(backup_path, 'w', encoding='utf-8') as dst:
-                        dst.write(src.read())
-            
             if isinstance(content, (dict, list)):
-                content = json.dumps(content, indent=4)
-            with open(filename, 'w', encoding='utf-8') as f: 
-                f.write(content)
-            TOOL_CALL_SUCCESS.labels(tool_name='write_file', status='success').inc()
+                # Structured content is dumped the way preview_write_diff renders it, as UTF-8 bytes
+                content = orjson.dumps(content, option=orjson.OPT_INDENT_2)
+            elif isinstance(content, str):
+                content = content.encode('utf-8')
+            # Rewriting identical content would only add a new inode and a backup of the same bytes
+            if not self._has_content(filename, content):
+                # Create backup before writing
+                self._backup_file(filename)
+                # Replace rather than truncate so a hardlinked backup keeps the old content
+                self._replace_file(filename, content)
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='write_file', status='success')
             return f"Successfully wrote content to '{filename}'."
         except Exception as e: 
-            TOOL_CALL_SUCCESS.labels(tool_name='write_file', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='write_file', status='error')
             return f"Error writing to file '{filename}': {e}"
 
     def delete_file(self, filename):
         try:
-            # Create backup before deleting
-            if os.path.exists(filename):
-                backup_path = os.path.join(BACKUP_DIR, f"{filename}_{int(time.time())}.bak")
-                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
-                with open(filename, 'r', encoding='utf-8') as src:
-                    with open(backup_path, 'w', encoding='utf-8') as dst:
-                        dst.write(src.read())
-            
-            os.remove(filename)
-            TOOL_CALL_SUCCESS.labels(tool_name='delete_file', status='success').inc()
+            # Moving the file into the backups is the backup and the delete in one rename
+            if not self._backup_file(filename, move=True):
+                os.remove(filename)
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='delete_file', status='success')
             return f"Successfully deleted file '{filename}'."
         except FileNotFoundError: 
-            TOOL_CALL_SUCCESS.labels(tool_name='delete_file', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='delete_file', status='error')
             return f"Error: File '{filename}' not found for deletion."
         except Exception as e: 
-            TOOL_CALL_SUCCESS.labels(tool_name='delete_file', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='delete_file', status='error')
             return f"Error deleting file '{filename}': {e}"
 
     def create_directory(self, directory_name):
         try:
             os.makedirs(directory_name, exist_ok=True)
-            TOOL_CALL_SUCCESS.labels(tool_name='create_directory', status='success').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='create_directory', status='success')
             return f"Successfully created directory '{directory_name}'."
         except Exception as e:
-            TOOL_CALL_SUCCESS.labels(tool_name='create_directory', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='create_directory', status='error')
             return f"Error creating directory '{directory_name}': {e}"
 
     def insert_at_line(self, filename, code_to_insert, line_number):
         try:
-            with open(filename, 'r', encoding='utf-8') as f: 
-                lines = f.readlines()
-            target_line = int(line_number)
-            target_index = target_line - 1
-            if not (0 <= target_index <= len(lines)): 
-                return f"Error: Line number {target_line} is out of bounds for file '{filename}' which has {len(lines)} lines."
-            base_indent = self._get_indentation(lines[target_index]) if target_index < len(lines) else ""
-            indented_code_lines = [f"{base_indent}{L}\n" for L in code_to_insert.splitlines()]
-            lines[target_index:target_index] = indented_code_lines
-            with open(filename, 'w', encoding='utf-8') as f: 
-                f.writelines(lines)
-            TOOL_CALL_SUCCESS.labels(tool_name='insert_at_line', status='success').inc()
+            with open(filename, 'r+b', buffering=IO_BUF) as f:
+                size = os.fstat(f.fileno()).st_size
+                target_line = int(line_number)
+                target_index = target_line - 1
+                with self._map_file(f, size) as mm:
+                    # Walk newlines up to the target line only; the rest of the file is never read
+                    offset, line_count = 0, 0
+                    while line_count < max(target_index, 0) and offset < size:
+                        newline = mm.find(b'\n', offset)
+                        offset = size if newline == -1 else newline + 1
+                        line_count += 1
+                    if not (0 <= target_index <= line_count):
+                        while offset < size:
+                            newline = mm.find(b'\n', offset)
+                            offset = size if newline == -1 else newline + 1
+                            line_count += 1
+                        return f"Error: Line number {target_line} is out of bounds for file '{filename}' which has {line_count} lines."
+                    if offset < size:
+                        line_end = mm.find(b'\n', offset)
+                        target_text = mm[offset:size if line_end == -1 else line_end].decode('utf-8')
+                        base_indent = self._get_indentation(target_text)
+                        prefix = ''
+                    else:
+                        base_indent = ""
+                        # Appending after a last line that has no newline of its own
+                        prefix = '\n' if size and mm[size - 1:size] != b'\n' else ''
+                indented_code = self._indent_block(code_to_insert, base_indent)
+                if indented_code:
+                    self._splice_file(filename, f, [(offset, 0, (prefix + indented_code + "\n").encode('utf-8'))])
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='insert_at_line', status='success')
             return f"Successfully inserted code at line {target_line} in '{filename}'."
         except FileNotFoundError: 
-            TOOL_CALL_SUCCESS.labels(tool_name='insert_at_line', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='insert_at_line', status='error')
             return f"Error: File '{filename}' not found."
         except ValueError: 
-            TOOL_CALL_SUCCESS.labels(tool_name='insert_at_line', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='insert_at_line', status='error')
             return f"Error: 'line_number' must be an integer."
         except Exception as e: 
-            TOOL_CALL_SUCCESS.labels(tool_name='insert_at_line', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='insert_at_line', status='error')
             return f"Error inserting code into '{filename}': {e}"
 
     def replace_code(self, filename, old_code, new_code):
         try:
-            with open(filename, 'r', encoding='utf-8') as f: 
-                content = f.read()
-            if old_code not in content: 
-                return f"Error: The specified 'old_code' was not found in '{filename}'. It must be an exact match."
-            first_line_of_old_code = old_code.splitlines()[0]
-            base_indent = self._get_indentation(first_line_of_old_code)
-            indented_new_code_lines = [f"{base_indent}{L}" for L in new_code.splitlines()]
-            indented_new_code = "\n".join(indented_new_code_lines)
-            new_content = content.replace(old_code, indented_new_code)
-            with open(filename, 'w', encoding='utf-8') as f: 
-                f.write(new_content)
-            TOOL_CALL_SUCCESS.labels(tool_name='replace_code', status='success').inc()
+            with open(filename, 'r+b', buffering=IO_BUF) as f:
+                size = os.fstat(f.fileno()).st_size
+                old_bytes = old_code.encode('utf-8')
+                new_bytes = self._replacement_code(old_code, new_code).encode('utf-8')
+                with self._map_file(f, size) as mm:
+                    if mm.find(old_bytes) == -1 and mm.find(b'\r\n') != -1:
+                        # read_file shows CRLF files with plain newlines; match and keep the file's endings
+                        old_bytes = old_bytes.replace(b'\n', b'\r\n')
+                        new_bytes = new_bytes.replace(b'\n', b'\r\n')
+                    offsets = []
+                    offset = mm.find(old_bytes)
+                    while offset != -1:
+                        offsets.append(offset)
+                        offset = mm.find(old_bytes, offset + len(old_bytes))
+                if not offsets: 
+                    return f"Error: The specified 'old_code' was not found in '{filename}'. It must be an exact match."
+                self._splice_file(filename, f, [(offset, len(old_bytes), new_bytes) for offset in offsets])
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='replace_code', status='success')
             return f"Successfully replaced code in '{filename}'."
         except FileNotFoundError: 
-            TOOL_CALL_SUCCESS.labels(tool_name='replace_code', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='replace_code', status='error')
             return f"Error: File '{filename}' not found."
         except Exception as e: 
-            TOOL_CALL_SUCCESS.labels(tool_name='replace_code', status='error').inc()
+            metrics_buffer.inc(TOOL_CALL_SUCCESS, tool_name='replace_code', status='error')
             return f"Error replacing code in '{filename}': {e}"
 
     def search_files(self, pattern, directory=".", file_pattern=None):
         try:
-            import fnmatch
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                return f"Error: Invalid search pattern '{pattern}': {e}"
+            results = self._ripgrep(pattern, directory, file_pattern) if RG_BINARY else None
+            if results is not None:
+                return "Search results:\n" + "\n".join(results) if results else "No matches found."
+            paths = self._walk_files(directory, file_pattern)
             results = []
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file_pattern and not fnmatch.fnmatch(file, file_pattern):
-                        continue
-                    file_path = os.path.join(root, file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            if re.search(pattern, content, re.IGNORECASE):
-                                results.append(f"Found in {file_path}")
-                    except:
-                        continue
+            # Read a window of files concurrently on the I/O pool and match them in walk order
+            for start in range(0, len(paths), SEARCH_READ_WINDOW):
+                window = paths[start:start + SEARCH_READ_WINDOW]
+                for file_path, content in zip(window, IO_POOL.map(self._read_text, window)):
+                    if content is not None and regex.search(content):
+                        results.append(f"Found in {file_path}")
             if results:
                 return "Search results:\n" + "\n".join(results)
             else:
@@ -351,15 +1015,74 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
         except Exception as e:
             return f"Error searching files: {e}"
 
+    @staticmethod
+    def _walk_files(directory, file_pattern=None) -> List[str]:
+        """Paths of the files under directory, outside SEARCH_SKIP_DIRS, whose name matches file_pattern."""
+        # Compiled once rather than through fnmatch's per-call cache lookup
+        matches = re.compile(fnmatch.translate(file_pattern)).match if file_pattern else None
+        paths, stack = [], [directory]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    entries = list(it)
+            except OSError:
+                continue  # Unreadable or vanished directory, which os.walk skipped too
+            subdirs = []
+            for entry in entries:
+                # DirEntry answers from the readdir type, so only symlinks cost a stat
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SEARCH_SKIP_DIRS:
+                        subdirs.append(entry.path)
+                elif (matches is None or matches(entry.name)) and entry.is_file():
+                    paths.append(entry.path)
+            stack.extend(reversed(subdirs))
+        return paths
+
+    @staticmethod
+    def _ripgrep(pattern, directory, file_pattern) -> Optional[List[str]]:
+        """'Found in' lines from rg, or None when rg cannot run the pattern (e.g. a
+        lookaround Rust's regex lacks), leaving the search to the Python scan."""
+        # Search what the Python scan would: hidden and ignored files too, minus SEARCH_SKIP_DIRS
+        argv = [RG_BINARY, '--files-with-matches', '--null', '--no-messages', '--hidden', '--no-ignore',
+                '--ignore-case', '--regexp', pattern]
+        if file_pattern:
+            argv += ['--glob', file_pattern]
+        argv += [f'--glob=!{name}' for name in sorted(SEARCH_SKIP_DIRS)]
+        argv += ['--', directory]
+        proc = subprocess.run(argv, capture_output=True, timeout=SEARCH_TIMEOUT)
+        # Exit status 1 means no matches; 2 means an error, which may still come with
+        # matches (an unreadable file) or none at all (a pattern rg rejected)
+        if proc.returncode == 2 and not proc.stdout:
+            return None
+        paths = sorted(os.fsdecode(p) for p in proc.stdout.split(b'\0') if p)
+        return [f"Found in {path}" for path in paths]
+
+    @staticmethod
+    def _read_text(file_path) -> Optional[str]:
+        try:
+            with open(file_path, 'rb', buffering=IO_BUF) as f:
+                head = f.read(SEARCH_BINARY_PROBE)
+                # A NUL in the first block marks a binary file (ripgrep's heuristic); skip the rest
+                if b'\0' in head:
+                    return None
+                return (head + f.read()).decode('utf-8')
+        except Exception:
+            return None
+
     def run_command(self, command):
-        # Sandboxed command execution - only allow safe commands
-        safe_commands = ['python', 'pip', 'npm', 'node', 'git', 'ls', 'cat', 'head', 'tail']
-        if not any(cmd in command.lower() for cmd in safe_commands):
+        # Sandboxed command execution - only allow safe commands. The command is run
+        # without a shell so the allowlisted executable is the only thing started.
+        try:
+            argv = shlex.split(command)
+        except ValueError as e:
+            return f"Error: Could not parse command: {e}"
+        # Only bare names looked up on PATH: './ls' or '/tmp/x/git' would be any program at all
+        if not argv or argv[0] not in SAFE_COMMANDS:
             return "Error: Command not allowed for security reasons."
         
         try:
-            import subprocess
-            result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+            # No stdin: 'cat' or 'python' without arguments would otherwise wait out the timeout
+            result = subprocess.run(argv, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=30)
             if result.returncode == 0:
                 return f"Command executed successfully:\n{result.stdout}"
             else:
@@ -367,18 +1090,16 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
         except Exception as e:
             return f"Error executing command: {e}"
 
-    def _execute_model_call(self, request_id: str, model_name=None):
-        start_time = time.time()
+    def _execute_model_call(self, request_id: str, state: ConversationState, model_name=None):
+        start_time = time.perf_counter()
         
         # Rate limiting
-        while True:
-            elapsed_time = time.time() - self.last_request_time
-            if elapsed_time < self.request_interval:
-                wait_time = self.request_interval - elapsed_time
-                time.sleep(wait_time)
-            break
-
-        self.last_request_time = time.time()
+        wait_time = self.rate_limiter.reserve()
+        if wait_time > MODEL_RATE_LIMIT_MAX_WAIT:
+            self.rate_limiter.refund()
+            return None, f"Rate limit exceeded, try again in {wait_time:.0f}s"
+        if wait_time > 0:
+            time.sleep(wait_time)
         
         api_key = os.getenv("OPENROUTER_API_KEY")
         if not api_key:
@@ -395,214 +1116,476 @@ When you need to use a tool, respond with a JSON object inside a ```json code bl
         else:
             models_to_try = self.active_model_list
 
-        for model in models_to_try:
+        messages = [{"role": "user", "content": self._build_prompt(state)}]
+        models = iter(models_to_try)
+        attempts: Dict[Any, str] = {}
+
+        # Set once a model has answered, so the others stop retrying
+        settled = Event()
+
+        def launch_next():
+            model = next(models, None)
+            if model is not None:
+                attempts[MODEL_CALL_POOL.submit(self._try_model, model, headers, messages, request_id, settled)] = model
+
+        launch_next()
+        while attempts:
+            # Hedge: if nothing has answered within hedge_delay, race the next model as well
+            done, _ = wait(attempts, timeout=self.hedge_delay, return_when=FIRST_COMPLETED)
+            if not done:
+                if len(attempts) < MODEL_HEDGE_FANOUT:
+                    launch_next()
+                continue
+            for future in done:
+                model = attempts.pop(future)
+                response = future.result()
+                if response is None:
+                    continue
+                settled.set()
+                for loser in attempts:
+                    if not loser.cancel():
+                        loser.add_done_callback(_close_model_response)
+                duration = time.perf_counter() - start_time
+                metrics_buffer.observe(MODEL_CALL_LATENCY, duration, model=model)
+                return response, None
+            if not attempts:
+                launch_next()
+
+        return None, "All models failed"
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._cb.get(model)
+        if breaker is None:
+            breaker = self._cb.setdefault(model, CircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RECOVERY_TIMEOUT, name=model))
+        return breaker
+
+    def _try_model(self, model: str, headers: dict, messages: list, request_id: str,
+                   settled: Optional[Event] = None):
+        """Return the streaming response once the model answers 200, or None if it fails."""
+        payload: Dict[str, Any] = {
+            "model": model,
+            "messages": messages,
+            "stream": True  # Enable streaming
+        }
+        breaker = self._breaker(model)
+        for attempt in range(1, MODEL_RETRY_ATTEMPTS + 1):
+            retry_after = None
             try:
-                payload = {
-                    "model": model,
-                    "messages": [
-                        {"role": "user", "content": self._build_prompt()}
-                    ],
-                    "stream": True  # Enable streaming
-                }
-                
-                response = self.circuit_breaker.call(
-                    lambda: requests.post(
-                        "https://openrouter.ai/api/v1/chat/completions",
+                response = breaker.call(
+                    lambda: http_session.post(
+                        OPENROUTER_URL,
                         headers=headers,
                         json=payload,
-                        stream=True
+                        stream=True,
+                        timeout=MODEL_TIMEOUT
                     )
                 )
-                
-                if response.status_code != 200:
-                    logger.log('WARNING', f'Model {model} returned status {response.status_code}', request_id, model=model, status_code=response.status_code, response_text=response.text)
-                    continue
-                
-                duration = time.time() - start_time
-                MODEL_CALL_LATENCY.labels(model=model).observe(duration)
-                
-                return response, None
-                
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.log('WARNING', f'Model {model} failed', request_id,
+                          model=model, attempt=attempt, error=str(e))
             except Exception as e:
+                # Includes an open breaker; retrying would not get anywhere
                 logger.log('ERROR', f'Model {model} failed', request_id, 
                           model=model, error=str(e))
-                continue
-
-        return None, "All models failed"
-
-    def _build_prompt(self):
-        system_prompt = self.messages[0]['content']
-        conversation_history = "\n".join(
-            [f"**{msg['role'].capitalize()}**: {msg['content']}" for msg in self.messages[1:]]
-        )
-        tools_definition = json.dumps([tool['function'] for tool in self.tools], indent=2)
-        
-        return f"""**System Prompt:**
-{system_prompt}
-
-**Available Tools:**
-```json
-{tools_definition}
-```
-
-**Conversation History:**
-{conversation_history}
-
-**Your Task:**
-Based on the conversation, provide a direct answer or call a tool if necessary. When you need to use a tool, respond with a JSON object inside a ```json code block.
-"""
+                return None
+            else:
+                if response.status_code == 200:
+                    return response
+                logger.log('WARNING', f'Model {model} returned status {response.status_code}', request_id, model=model, status_code=response.status_code, attempt=attempt, response_text=response.text)
+                response.close()
+                if response.status_code not in MODEL_RETRY_STATUSES:
+                    return None
+                retry_after = response.headers.get('Retry-After')
+            if attempt == MODEL_RETRY_ATTEMPTS:
+                break
+            delay = _retry_delay(attempt, retry_after)
+            if delay is None or (settled is not None and settled.wait(delay)):
+                break
+            if settled is None:
+                time.sleep(delay)
+        return None
+
+    def _build_prompt(self, state: ConversationState):
+        # Only the history changes between calls; the text around it is rendered once in __init__
+        return "".join((self._prompt_head, "\n".join(state.history_parts), PROMPT_TAIL))
 
 # Global assistant instance
 assistant = EnhancedAIAssistant()
-assistant_lock = Lock()
+
+def get_session_id(body_session_id: Optional[str] = None) -> str:
+    """Resolve the caller's session from the X-Session-ID header, body or query string."""
+    return (request.headers.get('X-Session-ID')
+            or body_session_id
+            or request.args.get('session_id')
+            or 'default')
+
+# Request bodies. msgspec decodes and type-checks them in one pass straight from the raw
+# bytes; unknown keys are ignored so older clients keep working.
+class SessionBody(msgspec.Struct):
+    session_id: Optional[str] = None
+
+class ChatBody(SessionBody):
+    message: str = ''
+
+class ActionBody(SessionBody):
+    name: str = ''
+    args: Dict[str, Any] = {}
+
+class ReplaceDiffBody(msgspec.Struct):
+    filename: str = ''
+    old_code: Optional[str] = ''
+    new_code: Optional[str] = ''
+
+class WriteDiffBody(msgspec.Struct):
+    filename: str = ''
+    content: Any = ''
+
+class DirectoryBody(SessionBody):
+    directory: str = ''
+
+class SaveChatBody(SessionBody):
+    markdown: str = ''
+    new_chat: bool = False
+
+def decode_body(schema):
+    """Decode the request body into schema; a malformed body or field surfaces as a 400."""
+    return msgspec.json.decode(request.get_data(), type=schema)
+
+@app.errorhandler(msgspec.DecodeError)
+def invalid_body(e):
+    # ValidationError subclasses DecodeError, and its message names the offending field
+    return jsonify({'error': f'Invalid request body: {e}'}), 400
+
+# Turns of one conversation run one at a time, so a second message cannot read or extend
+# the history while the first is still with the model; different sessions never wait on
+# each other. A lock lives only while some request holds a reference to it.
+SESSION_LOCK_TIMEOUT = 120
+SESSION_BUSY = {'error': 'This session is still answering a previous message'}
+_session_locks: 'WeakValueDictionary[str, Lock]' = WeakValueDictionary()
+_session_locks_guard = Lock()
+
+def session_lock(session_id: str) -> Lock:
+    with _session_locks_guard:
+        lock = _session_locks.get(session_id)
+        if lock is None:
+            lock = _session_locks[session_id] = Lock()
+        return lock
 
 # Routes
+# nginx advertises an internal location via X-Accel-Prefix; pages are then answered
+# with X-Accel-Redirect and nginx sends the file itself. Requests that reach the app
+# directly get the file through wsgi.file_wrapper, which gunicorn sends with sendfile(2).
+def send_page(directory: str, filename: str):
+    accel_prefix = request.headers.get('X-Accel-Prefix')
+    if accel_prefix:
+        response = Response(mimetype='text/html')
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{directory}/{filename}"
+        return response
+    return send_from_directory(directory, filename, conditional=True)
+
+# Static assets linked as /<name>?v=<digest of the file> are cached by browsers for a year:
+# a changed file has a new digest and therefore a new URL. index.html carries the current
+# digests (the tests check them); a missing or stale v= gets the usual ETag revalidation.
+STATIC_ASSET_MAX_AGE = 365 * 24 * 3600
+
+def asset_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=5).hexdigest()
+
+with os.scandir(app.static_folder) as _it:
+    STATIC_DIGESTS = {e.name: asset_digest(e.path) for e in _it if e.name.endswith(('.js', '.css'))}
+
+@app.after_request
+def cache_versioned_assets(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        version = request.args.get('v')
+        if version and version == STATIC_DIGESTS.get(request.view_args.get('filename')):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_ASSET_MAX_AGE
+            response.cache_control.immutable = True
+    return response
+
 @app.route('/')
 def serve_index():
-    return send_from_directory('static', 'index.html')
+    return send_page('static', 'index.html')
 
 @app.route('/upgrade')
 def serve_upgrade():
-    return send_from_directory('upgrade/ui', 'upgrade_index.html')
+    return send_page('upgrade/ui', 'upgrade_index.html')
 
 @app.route('/metrics')
 def metrics():
     return Response(prometheus_client.generate_latest(), mimetype='text/plain')
 
+# Probes hit /health constantly. Only the timestamp changes, so the rest of the body is
+# encoded once and the request skips building and serializing a dict.
+HEALTH_BODY_PREFIX = orjson.dumps({'status': 'healthy', 'timestamp': ''})[:-2]
+
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+    body = HEALTH_BODY_PREFIX + datetime.utcnow().isoformat().encode('ascii') + b'"}'
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/chat', methods=['POST'])
 @log_request
 def api_chat():
-    data = request.get_json(force=True)
-    user_text = data.get('message', '').strip()
+    body = decode_body(ChatBody)
+    user_text = body.message.strip()
     if not user_text:
         return jsonify({'error': 'Empty message'}), 400
 
     request_id = getattr(request, 'request_id', 'unknown')
-    response_data = process_user_message(user_text, request_id)
+    session_id = get_session_id(body.session_id)
+    lock = session_lock(session_id)
+    if not lock.acquire(timeout=SESSION_LOCK_TIMEOUT):
+        return jsonify(SESSION_BUSY), 409
+    try:
+        response_data = process_user_message(user_text, request_id, session_id)
+    finally:
+        lock.release()
     return jsonify(response_data)
 
 @app.route('/api/chat/stream', methods=['POST'])
 @log_request
 def api_chat_stream():
-    data = request.get_json(force=True)
-    user_text = data.get('message', '').strip()
+    body = decode_body(ChatBody)
+    user_text = body.message.strip()
     if not user_text:
         return jsonify({'error': 'Empty message'}), 400
 
     request_id = getattr(request, 'request_id', 'unknown')
+    session_id = get_session_id(body.session_id)
+
+    lock = session_lock(session_id)
 
     def generate():
-        for chunk in process_user_message_stream(user_text, request_id):
-            yield f"data: {json.dumps(chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        # Taken once the stream starts and released when it ends or the client goes away
+        if not lock.acquire(timeout=SESSION_LOCK_TIMEOUT):
+            yield sse_event(SESSION_BUSY)
+            yield SSE_DONE
+            return
+        try:
+            for chunk in process_user_message_stream(user_text, request_id, session_id):
+                yield sse_event(chunk)
+            yield SSE_DONE
+        finally:
+            lock.release()
 
-    return Response(generate(), mimetype='text/event-stream')
+    return sse_response(generate())
 
-def process_user_message(user_text: str, request_id: str) -> dict:
-    """Process user message with enhanced error handling and logging."""
-    with assistant_lock:
-        assistant.messages.append({"role": "user", "content": user_text})
-        
-        response_message, error = assistant._execute_model_call(request_id)
-        if error:
-            logger.log('ERROR', f'Model call failed: {error}', request_id)
-            return {"error": error}
+# Server-sent event framing, shared by the upstream parser and our own streams
+SSE_DATA_PREFIX = b'data: '
+SSE_DONE_MARKER = b'[DONE]'
+SSE_DONE = SSE_DATA_PREFIX + SSE_DONE_MARKER + b"\n\n"
 
-        # Process streaming response
-        full_response = ""
-        tool_call_found = None
-        
-        for line in response_message.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]
-                    if data == '[DONE]':
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        if 'choices' in chunk and chunk['choices']:
-                            delta = chunk['choices'][0].get('delta', {})
-                            if 'content' in delta:
-                                full_response += delta['content']
-                    except json.JSONDecodeError:
-                        JSON_PARSE_FAILURES.inc()
-                        continue
-
-        # Try to extract tool call
-        try:
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', full_response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                parsed_json = json.loads(json_str)
-                if parsed_json and "tool_call" in parsed_json:
-                    tool_call_found = parsed_json['tool_call']
-        except (json.JSONDecodeError, AttributeError):
-            JSON_PARSE_FAILURES.inc()
-
-        assistant.messages.append({'role': 'assistant', 'content': full_response})
-        
-        if tool_call_found:
-            return handle_tool_call(tool_call_found, request_id)
-        else:
-            return {'reply': full_response}
+def sse_event(payload: dict) -> bytes:
+    return SSE_DATA_PREFIX + orjson.dumps(payload) + b"\n\n"
 
-def process_user_message_stream(user_text: str, request_id: str):
-    """Process user message with streaming response."""
-    with assistant_lock:
-        assistant.messages.append({"role": "user", "content": user_text})
-        
-        response_message, error = assistant._execute_model_call(request_id)
-        if error:
-            logger.log('ERROR', f'Model call failed: {error}', request_id)
-            yield {"error": error}
+# Tokens must reach the browser as they are produced: tell nginx (and any other proxy or
+# cache on the way) not to buffer the stream. nginx's gzip leaves text/event-stream alone.
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_response(events) -> Response:
+    return Response(events, content_type='text/event-stream', headers=SSE_HEADERS)
+
+def wants_event_stream() -> bool:
+    """True when the client asked for SSE over JSON in its Accept header."""
+    return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+
+def stream_model_reply(response_message, state: ConversationState):
+    """Relay model deltas as SSE events as they arrive, recording the reply once the stream ends."""
+    parts = []
+    try:
+        for content in iter_stream_content(response_message):
+            parts.append(content)
+            yield sse_event({"type": "content", "content": content})
+        yield sse_event({"type": "complete"})
+        yield SSE_DONE
+    finally:
+        state.append({'role': 'assistant', 'content': "".join(parts)})
+
+def iter_sse_data(response):
+    """Yield the payload of each `data:` line of an SSE response as a memoryview.
+
+    Chunks are consumed as they arrive and split on newlines in C; lines stay bytes
+    and the payload is a view past the prefix, so nothing is decoded or copied per line.
+    """
+    prefix, skip = SSE_DATA_PREFIX, len(SSE_DATA_PREFIX)
+    pending = b''
+    for chunk in response.iter_content(chunk_size=None):
+        lines = (pending + chunk if pending else chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.startswith(prefix):
+                yield memoryview(line)[skip:-1 if line.endswith(b'\r') else None]
+    if pending.startswith(prefix):
+        yield memoryview(pending)[skip:]
+
+def iter_stream_content(response):
+    """Yield the content deltas of an OpenRouter SSE response until [DONE]."""
+    # Runs once per token; bind the parser and its error type outside the loop
+    loads, decode_error = orjson.loads, orjson.JSONDecodeError
+    for data in iter_sse_data(response):
+        if data == SSE_DONE_MARKER:
+            break
+        try:
+            chunk = loads(data)
+        except decode_error:
+            metrics_buffer.inc(JSON_PARSE_FAILURES)
+            continue
+        # Only choices[0].delta.content is used. Walk straight to it without building default dicts,
+        # and drop empty deltas (role-only and finish chunks) instead of relaying them as events
+        choices = chunk.get('choices') if type(chunk) is dict else None
+        if choices:
+            delta = choices[0].get('delta')
+            if delta:
+                content = delta.get('content')
+                if content:
+                    yield content
+
+class ToolCallScanner:
+    """Incrementally detect the ```json tool-call block while a reply streams in."""
+
+    OPEN_FENCE = '```json'
+    CLOSE_FENCE = '```'
+
+    def __init__(self):
+        self.tool_call: Optional[dict] = None
+        self.done = False
+        self._tail = ''     # end of the text seen so far that may be a partial opening fence
+        self._fence = None  # body of the open fence, None while scanning plain text
+        self._scanned = 0   # offset in _fence already checked for the closing fence
+
+    def feed(self, text: str):
+        """Consume one content delta; the work done is proportional to the delta."""
+        if self.done:
+            return
+        if self._fence is None:
+            buf = self._tail + text
+            start = buf.find(self.OPEN_FENCE)
+            if start == -1:
+                self._tail = buf[-(len(self.OPEN_FENCE) - 1):]
+                return
+            self._tail = ''
+            self._fence = ''
+            text = buf[start + len(self.OPEN_FENCE):]
+        self._fence += text
+        end = self._fence.find(self.CLOSE_FENCE, max(0, self._scanned - len(self.CLOSE_FENCE) + 1))
+        if end == -1:
+            self._scanned = len(self._fence)
+            return
+        self.done = True
+        body = self._fence[:end].strip()
+        self._fence = None
+        if not body.startswith('{'):
+            return
+        try:
+            parsed_json = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            metrics_buffer.inc(JSON_PARSE_FAILURES)
             return
+        if isinstance(parsed_json, dict) and "tool_call" in parsed_json:
+            self.tool_call = parsed_json['tool_call']
 
-        full_response = ""
-        tool_call_found = None
-        
-        for line in response_message.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]
-                    if data == '[DONE]':
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        if 'choices' in chunk and chunk['choices']:
-                            delta = chunk['choices'][0].get('delta', {})
-                            if 'content' in delta and delta['content'] is not None:
-                                content = delta['content']
-                                full_response += content
-                                yield {"type": "content", "content": content}
-                    except json.JSONDecodeError:
-                        JSON_PARSE_FAILURES.inc()
-                        continue
-
-        # Try to extract tool call
-        try:
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', full_response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                parsed_json = json.loads(json_str)
-                if parsed_json and "tool_call" in parsed_json:
-                    tool_call_found = parsed_json['tool_call']
-        except (json.JSONDecodeError, AttributeError):
-            JSON_PARSE_FAILURES.inc()
-
-        assistant.messages.append({'role': 'assistant', 'content': full_response})
-        
-        if tool_call_found:
-            yield {"type": "tool_call", "tool_call": tool_call_found}
+    def finish(self, text: str):
+        """Fall back to an unfenced {"tool_call": ...} object once a reply without a fence has ended.
+
+        The object is delimited by one linear pass matching braces outside of strings,
+        so a long reply never costs more than a single scan.
+        """
+        if self.done:
+            return
+        self.done = True
+        key = text.find('"tool_call"')
+        if key == -1:
+            return
+        start = text.rfind('{', 0, key)
+        if start == -1 or text[start + 1:key].strip():
+            return
+        depth, in_string, escaped = 0, False, False
+        for end in range(start, len(text)):
+            ch = text[end]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    break
         else:
-            yield {"type": "complete", "reply": full_response}
+            return
+        try:
+            parsed_json = orjson.loads(text[start:end + 1])
+        except orjson.JSONDecodeError:
+            metrics_buffer.inc(JSON_PARSE_FAILURES)
+            return
+        if isinstance(parsed_json, dict) and "tool_call" in parsed_json:
+            self.tool_call = parsed_json['tool_call']
 
-def handle_tool_call(tool_call: dict, request_id: str) -> dict:
+def process_user_message(user_text: str, request_id: str, session_id: str) -> dict:
+    """Process user message with enhanced error handling and logging."""
+    state = assistant.get_session(session_id)
+    state.append({"role": "user", "content": user_text})
+    
+    response_message, error = assistant._execute_model_call(request_id, state)
+    if error:
+        logger.log('ERROR', f'Model call failed: {error}', request_id)
+        return {"error": error}
+
+    # Process streaming response
+    parts = []
+    scanner = ToolCallScanner()
+    for content in iter_stream_content(response_message):
+        parts.append(content)
+        scanner.feed(content)
+    full_response = "".join(parts)
+    scanner.finish(full_response)
+    tool_call_found = scanner.tool_call
+
+    state.append({'role': 'assistant', 'content': full_response})
+    
+    if tool_call_found:
+        return handle_tool_call(tool_call_found, request_id, state)
+    else:
+        return {'reply': full_response}
+
+def process_user_message_stream(user_text: str, request_id: str, session_id: str):
+    """Process user message with streaming response."""
+    state = assistant.get_session(session_id)
+    state.append({"role": "user", "content": user_text})
+    
+    response_message, error = assistant._execute_model_call(request_id, state)
+    if error:
+        logger.log('ERROR', f'Model call failed: {error}', request_id)
+        yield {"error": error}
+        return
+
+    parts = []
+    scanner = ToolCallScanner()
+    for content in iter_stream_content(response_message):
+        parts.append(content)
+        scanner.feed(content)
+        yield {"type": "content", "content": content}
+    full_response = "".join(parts)
+    scanner.finish(full_response)
+    tool_call_found = scanner.tool_call
+
+    state.append({'role': 'assistant', 'content': full_response})
+    
+    if tool_call_found:
+        yield {"type": "tool_call", "tool_call": tool_call_found}
+    else:
+        yield {"type": "complete", "reply": full_response}
+
+def handle_tool_call(tool_call: dict, request_id: str, state: ConversationState) -> dict:
     """Handle tool call with enhanced validation and logging."""
     tool_name = tool_call.get('name')
     tool_args = tool_call.get('arguments', {})
@@ -610,8 +1593,7 @@ def handle_tool_call(tool_call: dict, request_id: str) -> dict:
     logger.log('INFO', f'Tool call requested', request_id, tool_name=tool_name, arguments=tool_args)
     
     # Check if tool is dangerous
-    dangerous_tools = {"write_file", "delete_file", "create_directory", "replace_code", "insert_at_line"}
-    if tool_name in dangerous_tools:
+    if tool_name in DANGEROUS_TOOLS:
         return {
             'action_request': {
                 'name': tool_name,
@@ -626,31 +1608,16 @@ def handle_tool_call(tool_call: dict, request_id: str) -> dict:
     
     try:
         result = function_to_call(**tool_args)
-        assistant.messages.append({"role": "tool", "name": tool_name, "content": result})
+        state.append({"role": "tool", "name": tool_name, "content": result})
         
         # Get AI's response after tool execution
-        response_message, error = assistant._execute_model_call(request_id)
+        response_message, error = assistant._execute_model_call(request_id, state)
         if error:
             return {"error": error}
         
-        full_response = ""
-        for line in response_message.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]
-                    if data == '[DONE]':
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        if 'choices' in chunk and chunk['choices']:
-                            delta = chunk['choices'][0].get('delta', {})
-                            if 'content' in delta:
-                                full_response += delta['content']
-                    except json.JSONDecodeError:
-                        continue
+        full_response = "".join(iter_stream_content(response_message))
         
-        assistant.messages.append({'role': 'assistant', 'content': full_response})
+        state.append({'role': 'assistant', 'content': full_response})
         return {'reply': full_response}
         
     except Exception as e:
@@ -660,235 +1627,810 @@ def handle_tool_call(tool_call: dict, request_id: str) -> dict:
 @app.route('/api/execute_action', methods=['POST'])
 @log_request
 def api_execute_action():
-    data = request.get_json(force=True)
-    tool_name = data.get('name')
-    tool_args = data.get('args')
+    body = decode_body(ActionBody)
+    tool_name = body.name
+    tool_args = body.args
     request_id = getattr(request, 'request_id', 'unknown')
 
     if not tool_name:
         return jsonify({'error': 'Missing tool name'}), 400
 
-    with assistant_lock:
-        logger.log('INFO', f'User confirmed execution', request_id, 
-                  tool_name=tool_name, arguments=tool_args)
-        
-        function_to_call = assistant.available_functions.get(tool_name)
-        if not function_to_call:
-            result = f"Error: Tool '{tool_name}' not found."
+    session_id = get_session_id(body.session_id)
+    lock = session_lock(session_id)
+    if not lock.acquire(timeout=SESSION_LOCK_TIMEOUT):
+        return jsonify(SESSION_BUSY), 409
+    try:
+        response = _execute_action(tool_name, tool_args, request_id, assistant.get_session(session_id))
+    except BaseException:
+        lock.release()
+        raise
+    # A streamed reply keeps the turn open until the server closes the response
+    response.call_on_close(lock.release)
+    return response
+
+def _execute_action(tool_name: str, tool_args, request_id: str, state: ConversationState) -> Response:
+    logger.log('INFO', f'User confirmed execution', request_id, 
+              tool_name=tool_name, arguments=tool_args)
+    
+    function_to_call = assistant.available_functions.get(tool_name)
+    if not function_to_call:
+        result = f"Error: Tool '{tool_name}' not found."
+    else:
+        try:
+            result = function_to_call(**tool_args)
+        except Exception as e:
+            result = f"Error executing tool {tool_name}: {e}"
+        if tool_name in DANGEROUS_TOOLS:
+            tree_cache.clear()
+            file_text_cache.clear()
+
+    state.append({"role": "tool", "name": tool_name, "content": result})
+
+    # Get AI's response after tool execution
+    response_message, error = assistant._execute_model_call(request_id, state)
+    if error:
+        return jsonify({"error": error})
+
+    if wants_event_stream():
+        return sse_response(stream_with_context(stream_model_reply(response_message, state)))
+
+    full_response = "".join(iter_stream_content(response_message))
+
+    state.append({'role': 'assistant', 'content': full_response})
+    return jsonify({'reply': full_response})
+
+# Unified diffs for the preview endpoints. Like git's xprepare, identical leading and
+# trailing lines are stripped first so SequenceMatcher only sees the changed middle;
+# for a small edit in a large file that is the difference between quadratic and linear.
+class _OpcodeMatcher(difflib.SequenceMatcher):
+    """SequenceMatcher whose opcodes are supplied, so get_grouped_opcodes can be reused."""
+
+    def __init__(self, opcodes):
+        self._opcodes = opcodes
+
+    def get_opcodes(self):
+        return self._opcodes
+
+# Below this many lines on both sides SequenceMatcher is quick and gives difflib's exact hunks
+PATIENCE_MIN_LINES = 500
+
+def _uses_patience(a_len: int, b_len: int) -> bool:
+    return _PatienceMatcher is not None and max(a_len, b_len) > PATIENCE_MIN_LINES
+
+def _diff_opcodes(a: List[str], b: List[str]) -> list:
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a_end, b_end = len(a) - suffix, len(b) - suffix
+
+    opcodes = [('equal', 0, prefix, 0, prefix)] if prefix else []
+    if prefix < a_end or prefix < b_end:
+        matcher_class = _PatienceMatcher if _uses_patience(a_end - prefix, b_end - prefix) else difflib.SequenceMatcher
+        matcher = matcher_class(None, a[prefix:a_end], b[prefix:b_end])
+        opcodes.extend((tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix)
+                       for tag, i1, i2, j1, j2 in matcher.get_opcodes())
+    if suffix:
+        opcodes.append(('equal', a_end, len(a), b_end, len(b)))
+    return opcodes
+
+def _format_range(start: int, stop: int) -> str:
+    # Same convention as difflib.unified_diff: 'start,length', or just 'start' for one line
+    beginning, length = start + 1, stop - start
+    if length == 1:
+        return str(beginning)
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+def _embed_opcodes(opcodes: list, offset: int, a_len: int, b_len: int, a_total: int, b_total: int) -> list:
+    """Opcodes of a span diff (a_len -> b_len lines) placed at line offset of otherwise equal files."""
+    shifted = [(tag, i1 + offset, i2 + offset, j1 + offset, j2 + offset) for tag, i1, i2, j1, j2 in opcodes]
+    if offset:
+        shifted.insert(0, ('equal', 0, offset, 0, offset))
+    if offset + a_len < a_total:
+        shifted.append(('equal', offset + a_len, a_total, offset + b_len, b_total))
+    merged: List[Tuple[str, int, int, int, int]] = []
+    for op in shifted:
+        # get_grouped_opcodes only trims context from single equal runs, so join neighbours
+        if merged and op[0] == 'equal' == merged[-1][0]:
+            prev = merged.pop()
+            op = ('equal', prev[1], op[2], prev[3], op[4])
+        merged.append(op)
+    return merged
+
+def unified_diff(a: List[str], b: List[str], fromfile: str = '', tofile: str = '', n: int = 3,
+                 opcodes: Optional[list] = None):
+    """Yield difflib.unified_diff(a, b, fromfile, tofile, n=n, lineterm='') lines.
+    opcodes, when already known for a -> b, skips computing them again."""
+    started = False
+    if opcodes is None:
+        if _rs_unified_diff is not None and not _uses_patience(len(a), len(b)):
+            # Matching and formatting both run in Rust
+            yield from _rs_unified_diff(a, b, fromfile, tofile, n=n, lineterm='')
+            return
+        opcodes = _diff_opcodes(a, b)
+    for group in _OpcodeMatcher(opcodes).get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield f'--- {fromfile}'
+            yield f'+++ {tofile}'
+        first, last = group[0], group[-1]
+        yield f'@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@'
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+# Decoded text of recently previewed or opened files. A preview is re-requested on every
+# keystroke while the file itself stays put, so a hit costs one stat() instead of a read
+# and decode. Entries are keyed on mtime, size and inode, which catches rewrites by
+# rename (a new inode) and in-place edits from a later mtime tick. insert_at_line and
+# replace_code edit in place, possibly within one tick and at the same size, so they
+# discard the file's entry themselves.
+# Concurrent misses on the same version share one read: the first caller reads and
+# the others wait on its Future, so a burst of previews of a cold file costs one read.
+class FileTextCache:
+    def __init__(self, capacity: int = 64, max_bytes: int = 32 << 20):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        # path -> [(mtime_ns, size, inode), text, lines or None]
+        self._entries: 'OrderedDict[str, list]' = OrderedDict()
+        self._bytes = 0
+        # (path, key) -> Future of the entry being read for that version
+        self._reads: Dict[tuple, Future] = {}
+        # Bumped by discard() and clear(): a read that started before either is not cached
+        self._generation = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(st: os.stat_result) -> tuple:
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def read(self, path: str) -> str:
+        return self._entry(path)[1]
+
+    def read_lines(self, path: str) -> tuple:
+        """(text, text.splitlines()) for path. The list is shared between callers: do not mutate it."""
+        return self._lines(self._entry(path))
+
+    def cached_lines(self, path: str) -> Optional[tuple]:
+        """read_lines(path) if the current version is cached, else None; never reads the file."""
+        try:
+            entry = self._lookup(path, self._key(os.stat(path)))
+        except OSError:
+            return None
+        return None if entry is None else self._lines(entry)
+
+    @staticmethod
+    def _lines(entry: list) -> tuple:
+        if entry[2] is None:
+            # Split on first use only; /api/file never needs the lines
+            entry[2] = entry[1].splitlines()
+        return entry[1], entry[2]
+
+    def _lookup(self, path: str, key: tuple) -> Optional[list]:
+        with self._lock:
+            return self._hit(path, key)
+
+    def _hit(self, path: str, key: tuple) -> Optional[list]:
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            self._entries.move_to_end(path)
+            return entry
+        return None
+
+    def _entry(self, path: str) -> list:
+        key = self._key(os.stat(path))
+        with self._lock:
+            entry = self._hit(path, key)
+            if entry is not None:
+                return entry
+            pending = self._reads.get((path, key))
+            if pending is None:
+                read: Future = Future()
+                self._reads[(path, key)] = read
+        if pending is not None:
+            return pending.result()
+        try:
+            entry = self._read(path)
+        except BaseException as e:
+            read.set_exception(e)
+            raise
         else:
-            try:
-                result = function_to_call(**tool_args)
-            except Exception as e:
-                result = f"Error executing tool {tool_name}: {e}"
-
-        assistant.messages.append({"role": "tool", "name": tool_name, "content": result})
-
-        # Get AI's response after tool execution
-        response_message, error = assistant._execute_model_call(request_id)
-        if error:
-            return jsonify({"error": error})
-
-        full_response = ""
-        for line in response_message.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]
-                    if data == '[DONE]':
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        if 'choices' in chunk and chunk['choices']:
-                            delta = chunk['choices'][0].get('delta', {})
-                            if 'content' in delta:
-                                full_response += delta['content']
-                    except json.JSONDecodeError:
-                        continue
-
-        assistant.messages.append({'role': 'assistant', 'content': full_response})
-        return jsonify({'reply': full_response})
+            read.set_result(entry)
+        finally:
+            with self._lock:
+                del self._reads[(path, key)]
+        return entry
+
+    def _read(self, path: str) -> list:
+        generation = self._generation
+        with open(path, 'rb', buffering=0) as f:
+            # Key on the descriptor that was read, not the earlier stat, so a file replaced
+            # in between is never cached under the old version's key
+            key = self._key(os.fstat(f.fileno()))
+            size = key[1]
+            if size >= MMAP_MIN_SIZE:
+                # Decode straight out of the page cache, skipping a bytes copy of the whole file
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    text = str(m, 'utf-8')
+            else:
+                text = f.read().decode('utf-8')
+        if '\r' in text:
+            # The newline translation text-mode open() would have done
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        entry = [key, text, None]
+        # A file too large to share the budget with a few others is read through uncached
+        if size <= self.max_bytes // 4:
+            with self._lock:
+                if generation != self._generation:
+                    return entry
+                old = self._entries.pop(path, None)
+                if old is not None:
+                    self._bytes -= old[0][1]
+                self._entries[path] = entry
+                self._bytes += size
+                while len(self._entries) > self.capacity or self._bytes > self.max_bytes:
+                    _, (old_key, _, _) = self._entries.popitem(last=False)
+                    self._bytes -= old_key[1]
+        return entry
+
+    def discard(self, path: str):
+        """Forget path, for a writer that may not have changed its stat key."""
+        with self._lock:
+            self._generation += 1
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[0][1]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+file_text_cache = FileTextCache()
+
+# Previews answer with NDJSON when the client prefers it: each diff goes out as frames of
+# {'type': 'snippet_diff' | 'file_diff', 'lines': [...]} while it is generated, then {'type': 'end', 'ok': true},
+# so the server never holds a whole joined diff or its JSON-escaped copy.
+DIFF_STREAM_BATCH = 512
+
+def wants_ndjson() -> bool:
+    """True when the client asked for NDJSON over JSON in its Accept header."""
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def diff_stream_response(diffs: Dict[str, Any]) -> Response:
+    """Stream each named iterable of diff lines as NDJSON frames, batched to amortize encoding."""
+    def frames():
+        for name, lines in diffs.items():
+            iterator = iter(lines)
+            while True:
+                batch = list(islice(iterator, DIFF_STREAM_BATCH))
+                if not batch:
+                    break
+                yield orjson.dumps({'type': name, 'lines': batch}, option=orjson.OPT_APPEND_NEWLINE)
+        yield orjson.dumps({'type': 'end', 'ok': True}, option=orjson.OPT_APPEND_NEWLINE)
+    return Response(frames(), mimetype='application/x-ndjson')
 
 @app.route('/api/preview_replace_diff', methods=['POST'])
 @log_request
 def api_preview_replace_diff():
-    data = request.get_json(force=True) or {}
-    filename = data.get('filename')
-    old_code = data.get('old_code', '')
-    new_code = data.get('new_code', '')
+    body = decode_body(ReplaceDiffBody)
+    filename = body.filename
+    old_code = body.old_code
+    new_code = body.new_code
     
     if not filename:
         return jsonify({'error': 'filename is required'}), 400
-    if old_code is None or new_code is None:
+    if not old_code or new_code is None:
         return jsonify({'error': 'old_code and new_code are required'}), 400
+    # Preview exactly what replace_code will write in place of each occurrence
+    new_code = EnhancedAIAssistant._replacement_code(old_code, new_code)
     
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            original = f.read()
+        path = safe_path(filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 403
+    # A cached file costs one stat(). Only a read from disk is worth the hop to IO_POOL,
+    # where it overlaps the snippet diff instead of running ahead of it.
+    file_text = file_text_cache.cached_lines(path)
+    pending_read = IO_POOL.submit(file_text_cache.read_lines, path) if file_text is None else None
+
+    # Diff 1: old_code vs its replacement. Nothing edited yet means both diffs are empty.
+    unedited = old_code == new_code
+    if not unedited:
+        old_lines = old_code.splitlines(keepends=False)
+        new_lines = new_code.splitlines(keepends=False)
+        snippet_ops = _diff_opcodes(old_lines, new_lines)
+        snippet_diff = list(unified_diff(old_lines, new_lines, fromfile='old_code', tofile='new_code',
+                                         opcodes=snippet_ops))
+
+    try:
+        original, orig_lines = file_text if pending_read is None else pending_read.result()
     except FileNotFoundError:
         return jsonify({'error': f"File '{filename}' not found."}), 404
-    
-    # Diff 1: old_code vs new_code
-    old_lines = old_code.splitlines(keepends=False)
-    new_lines = new_code.splitlines(keepends=False)
-    snippet_diff = difflib.unified_diff(old_lines, new_lines, fromfile='old_code', tofile='new_code', lineterm='')
-    
-    # Diff 2: original file vs preview with replacement applied
-    try:
-        would_be = original.replace(old_code, new_code)
-    except Exception:
-        would_be = original
-    
-    orig_lines = original.splitlines(keepends=False)
-    would_lines = would_be.splitlines(keepends=False)
-    file_diff = difflib.unified_diff(orig_lines, would_lines, fromfile=filename + ':original', tofile=filename + ':preview', lineterm='')
+    idx = original.find(old_code)
+    if idx < 0:
+        return jsonify({'ok': False, 'error': f"old_code not found in '{filename}'."}), 404
+    if unedited:
+        if wants_ndjson():
+            return diff_stream_response({})
+        return jsonify({'ok': True, 'snippet_diff': '', 'file_diff': ''})
+
+    # Diff 2: original file vs preview with every occurrence replaced, as replace_code does
+    end = idx + len(old_code)
+    unique = original.find(old_code, end) < 0
+
+    # When the replaced span is whole lines, everything outside it is unchanged: the preview
+    # lines are a splice of orig_lines and the snippet opcodes already describe the file diff.
+    # Only a span that starts or ends mid-line needs the preview built, split and diffed again.
+    starts_line = idx == 0 or original[idx - 1] == '\n'
+    ends_line = end == len(original) or (old_code.endswith('\n') and (not new_code or new_code.endswith('\n')))
+    file_ops = file_diff = None
+    if not unique:
+        # One C-level pass over the file replaces the same non-overlapping matches as the tool
+        would_lines = original.replace(old_code, new_code).splitlines(keepends=False)
+    elif not starts_line or not ends_line:
+        would_lines = (original[:idx] + new_code + original[end:]).splitlines(keepends=False)
+    elif not snippet_diff:
+        # The spliced lines equal the ones they replace, so the preview is orig_lines itself.
+        # Elsewhere an only-line-break edit (old 'a\n', new 'a') can still join file lines.
+        file_diff = []
+    else:
+        # Counting '\n' finds the span's first line, unless the file also breaks lines on
+        # characters splitlines() knows but count() does not (lone '\r', '\f', U+2028, ...)
+        if len(orig_lines) == original.count('\n') + (not original.endswith('\n')):
+            start = original.count('\n', 0, idx)
+        else:
+            start = len(original[:idx].splitlines())
+        would_lines = orig_lines[:start] + new_lines + orig_lines[start + len(old_lines):]
+        file_ops = _embed_opcodes(snippet_ops, start, len(old_lines), len(new_lines),
+                                  len(orig_lines), len(would_lines))
+    if file_diff is None:
+        file_diff = unified_diff(orig_lines, would_lines, fromfile=filename + ':original', tofile=filename + ':preview',
+                                 opcodes=file_ops)
+    if wants_ndjson():
+        return diff_stream_response({'snippet_diff': snippet_diff, 'file_diff': file_diff})
     
     return jsonify({
         'ok': True,
-        'snippet_diff': '\n'.join(list(snippet_diff)),
-        'file_diff': '\n'.join(list(file_diff))
+        'snippet_diff': '\n'.join(snippet_diff),
+        'file_diff': '\n'.join(file_diff)
     })
 
 @app.route('/api/preview_write_diff', methods=['POST'])
 @log_request
 def api_preview_write_diff():
-    data = request.get_json(force=True) or {}
-    filename = data.get('filename')
-    content = data.get('content', '')
+    body = decode_body(WriteDiffBody)
+    filename = body.filename
+    content = body.content
     
     if not filename:
         return jsonify({'error': 'filename is required'}), 400
     if content is None:
         return jsonify({'error': 'content is required'}), 400
     
-    original = ''
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            original = f.read()
+        path = safe_path(filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 403
+    # As in the replace preview, a read from disk overlaps rendering the content
+    file_text = file_text_cache.cached_lines(path)
+    pending_read = IO_POOL.submit(file_text_cache.read_lines, path) if file_text is None else None
+    if not isinstance(content, str):
+        content = orjson.dumps(content, option=orjson.OPT_INDENT_2).decode('utf-8')
+    
+    try:
+        original, orig_lines = file_text if pending_read is None else pending_read.result()
     except FileNotFoundError:
-        # Treat as creating a new file; original stays empty
-        original = ''
+        # Treat as creating a new file
+        original, orig_lines = '', []
     
-    orig_lines = original.splitlines(keepends=False)
-    new_lines = (content if isinstance(content, str) else json.dumps(content, indent=2)).splitlines(keepends=False)
-    file_diff = difflib.unified_diff(orig_lines, new_lines, fromfile=filename + ':original', tofile=filename + ':new', lineterm='')
+    if content == original:
+        if wants_ndjson():
+            return diff_stream_response({})
+        return jsonify({'ok': True, 'file_diff': ''})
+    new_lines = content.splitlines()
+    file_diff = unified_diff(orig_lines, new_lines, fromfile=filename + ':original', tofile=filename + ':new')
+    if wants_ndjson():
+        return diff_stream_response({'file_diff': file_diff})
     
     return jsonify({
         'ok': True,
-        'file_diff': '\n'.join(list(file_diff))
+        'file_diff': '\n'.join(file_diff)
     })
 
+# Bulky generated directories left out of the project tree (dot entries are skipped too)
+TREE_SKIP_NAMES = frozenset({'__pycache__', 'node_modules'})
+# Most entries /api/tree returns per request; larger directories are paged with ?offset=
+TREE_PAGE_LIMIT = 5000
+
+# Serialized /api/tree pages keyed by directory and page. A listing only changes when entries
+# are added, removed or renamed, all of which bump the directory's mtime, so each hit is
+# one stat() instead of a scandir and re-serialization. Mutating tools also clear it in
+# case two changes land within the filesystem's timestamp granularity.
+class TreeCache:
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self._entries: 'OrderedDict[Tuple[str, tuple], Tuple[int, bytes]]' = OrderedDict()
+        self._lock = Lock()
+
+    def lookup(self, path: str, page: tuple) -> tuple:
+        """Return (mtime_ns, cached body or None) for one page of path."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        key = (path, page)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != mtime_ns:
+                return mtime_ns, None
+            self._entries.move_to_end(key)
+            return mtime_ns, entry[1]
+
+    def put(self, path: str, page: tuple, mtime_ns: int, body: bytes) -> bytes:
+        # mtime_ns is read before listing, so a change made during the scan just forces a rebuild
+        key = (path, page)
+        with self._lock:
+            self._entries[key] = (mtime_ns, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+tree_cache = TreeCache()
+
 @app.route('/api/tree', methods=['GET'])
 @log_request
 def api_tree():
     """Get project tree structure based on session."""
-    session_id = request.args.get('session_id', 'default')
-    path = session_paths.get(session_id, '.') # Get path from session state
+    path = assistant.get_session(get_session_id()).cwd
     try:
-        items = []
-        base_path = os.path.abspath(path)
-
-        # Get the list of directories and files
-        with os.scandir(base_path) as it:
-            for entry in it:
-                if not entry.name.startswith('.') and entry.name != '__pycache__':
-                    item_path = os.path.join(base_path, entry.name)
-                    if entry.is_dir():
-                        items.append({'type': 'directory', 'name': entry.name, 'path': item_path})
-                    else:
-                        items.append({'type': 'file', 'name': entry.name, 'path': item_path})
-        
-        # Sort items: directories first, then files, all alphabetically
-        items.sort(key=lambda x: (x['type'] != 'directory', x['name'].lower()))
-
-        # Determine parent directory path
-        project_root = os.path.abspath('.')
-        parent_path = os.path.dirname(base_path) if base_path != project_root else None
-
-        return jsonify({
-            'tree': items,
-            'current_path': base_path,
-            'parent_path': parent_path
-        })
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', TREE_PAGE_LIMIT)), 1), TREE_PAGE_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    columns = request.args.get('layout') == 'columns'
+    page = (offset, limit, columns)
+    try:
+        mtime_ns, body = tree_cache.lookup(path, page)
+        if body is None:
+            body = tree_cache.put(path, page, mtime_ns, build_tree_listing(path, offset, limit, columns))
+        return Response(body, mimetype='application/json')
     except Exception as e:
         logger.log('ERROR', f'Failed to get project tree for path {path}: {str(e)}', getattr(request, 'request_id', 'unknown'))
         return jsonify({'error': str(e)}), 500
 
+def build_tree_listing(base_path: str, offset: int = 0, limit: int = TREE_PAGE_LIMIT, columns: bool = False) -> bytes:
+    """Serialized page of the single-level listing of base_path, as returned by /api/tree.
+
+    By default entries are a 'tree' list of {type, name, path} objects. With columns they
+    are parallel 'names', 'types' and 'paths' arrays instead: no dict per entry to build,
+    and three flat string arrays for orjson to write.
+    """
+    entries = []
+    # Get the list of directories and files. DirEntry carries the joined path and, except
+    # for symlinks, the file type from readdir, so listing a directory costs no stat() calls.
+    with os.scandir(base_path) as it:
+        for entry in it:
+            name = entry.name
+            if name[0] == '.' or name in TREE_SKIP_NAMES:
+                continue
+            entries.append((not entry.is_dir(), name.lower(), name, entry.path))
+    
+    # Sort items: directories first, then files, all alphabetically. Only the requested
+    # page is shaped and serialized, however large the directory is, and when it is an
+    # early page of a big directory only the entries up to it are ordered at all.
+    end = offset + limit
+    if end < len(entries) // 4:
+        page = heapq.nsmallest(end, entries)[offset:]
+    else:
+        page = sorted(entries)[offset:end]
+    listing: Dict[str, Any]
+    if columns:
+        listing = {'names': [entry[2] for entry in page],
+                   'types': ['file' if entry[0] else 'directory' for entry in page],
+                   'paths': [entry[3] for entry in page]}
+    else:
+        listing = {'tree': [{'type': 'file' if is_file else 'directory', 'name': name, 'path': item_path}
+                            for is_file, _, name, item_path in page]}
+
+    # Determine parent directory path
+    parent_path = os.path.dirname(base_path) if base_path != PROJECT_ROOT else None
+
+    return orjson.dumps({
+        **listing,
+        'current_path': base_path,
+        'parent_path': parent_path,
+        'offset': offset,
+        'total': len(entries),
+        'truncated': offset + limit < len(entries)
+    })
+
 @app.route('/api/change_directory', methods=['POST'])
 @log_request
 def change_directory():
     """Change the current directory for a session."""
-    data = request.get_json(force=True)
-    session_id = data.get('session_id', 'default')
-    directory = data.get('directory')
+    body = decode_body(DirectoryBody)
+    directory = body.directory
     
     if not directory or not os.path.isdir(directory):
         return jsonify({'success': False, 'error': 'Invalid directory specified'}), 400
+    # /api/tree lists whatever the session points at, so hold it to the file endpoints' root
+    try:
+        path = safe_path(directory)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 403
         
-    session_paths[session_id] = os.path.abspath(directory)
-    return jsonify({'success': True, 'current_path': session_paths[session_id]})
+    state = assistant.get_session(get_session_id(body.session_id))
+    state.set_cwd(path)
+    return jsonify({'success': True, 'current_path': state.cwd})
 
 @app.route('/api/current_directory', methods=['GET'])
 @log_request
 def get_current_directory():
     """Get the current directory for a session."""
-    session_id = request.args.get('session_id', 'default')
-    current_path = session_paths.get(session_id, '.')
-    return jsonify({'current_directory': os.path.abspath(current_path)})
+    return jsonify({'current_directory': assistant.get_session(get_session_id()).cwd})
 
 @app.route('/api/file', methods=['GET'])
 @log_request
 def api_file():
-    """Get file content."""
+    """Get file content. With ?raw=1 the file itself is streamed as text/plain."""
     filename = request.args.get('path')
     if not filename:
         return jsonify({'error': 'path parameter required'}), 400
+    try:
+        path = safe_path(filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 403
+    
+    if request.args.get('raw') == '1':
+        # send_file streams from disk (sendfile under gunicorn) and answers ETag/Range
+        # requests, so the content is never decoded or JSON-escaped in Python
+        if not os.path.isfile(path):
+            return jsonify({'error': 'File not found'}), 404
+        # download_name names the file in an inline Content-Disposition (RFC 5987-encoded
+        # when it is not ASCII), which a custom X-Filename header could not carry
+        return send_file(path, mimetype='text/plain', conditional=True, download_name=os.path.basename(path))
     
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return jsonify({'content': content})
+        return jsonify({'content': file_text_cache.read(path)})
     except FileNotFoundError:
         return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Chat saves are written here so the request returns without waiting on the disk.
+# The executor joins its workers at interpreter exit, so queued saves are not lost.
+CHAT_IO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='chat-io')
+# The executor's queue is unbounded; past this many unfinished saves a new one is refused
+# with a 503 instead of piling transcripts up in memory behind a slow disk
+CHAT_SAVE_MAX_PENDING = int(os.getenv('CHAT_SAVE_MAX_PENDING', '256'))
+_chat_save_slots = BoundedSemaphore(CHAT_SAVE_MAX_PENDING)
+
+def _create_chat_file(session_id: str) -> str:
+    """Claim a new, empty chat file for session_id and return its name.
+
+    The timestamp keeps name order as age order; the session tag and O_EXCL keep two saves
+    in the same second, from one session or several, from ever sharing a file.
+    """
+    ts = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    tag = hashlib.blake2b(session_id.encode('utf-8'), digest_size=4).hexdigest()
+    fname, n = f"chat_{ts}_{tag}.md", 0
+    while True:
+        try:
+            os.close(os.open(os.path.join(CHATS_DIR, fname), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return fname
+        except FileExistsError:
+            n += 1
+            fname = f"chat_{ts}_{tag}-{n}.md"
+
+def _write_chat(path: str, content: bytes, offset: int = 0, previous: Optional[Future] = None):
+    """Write content to path, rewriting only from offset on; the bytes before it are already there.
+
+    previous is this process's earlier save of the same file. It was queued first, so it is
+    running or done by now; wait for it, and rewrite everything if it failed.
+    """
+    if previous is not None and previous.exception() is not None:
+        offset = 0
+    if offset:
+        # Appending only adds bytes past what the reader already has, so it stays in place.
+        # A prefix another worker saved may not be on disk yet; then everything is rewritten.
+        with open(path, 'r+b', buffering=0) as f:
+            if os.fstat(f.fileno()).st_size >= offset:
+                os.pwrite(f.fileno(), memoryview(content)[offset:], offset)
+                os.ftruncate(f.fileno(), len(content))
+                return
+    # A whole rewrite goes to a temporary file that is synced and renamed over the chat,
+    # so a crash leaves the old transcript or the new one, never a truncated mix. The
+    # dot prefix and random suffix keep it out of the .md listing meanwhile.
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + name + '.')
+    try:
+        # mkstemp creates 0600; chats stay readable like files open() would create
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb', buffering=IO_BUF) as f:
+            f.write(content)
+            f.flush()
+            os.fdatasync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# Sorted chat filenames, rescanned only when CHATS_DIR's mtime changes. save_chat adds
+# its own file with insort, so a typical list request is one stat(). If another worker
+# saves at the same moment its file shows up at the next change.
+class ChatIndex:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: List[str] = []
+        self._mtime_ns: Optional[int] = None
+        self._pending: Dict[str, Future] = {}
+        # Serialized /api/chats bodies by limit, for the current _files only
+        self._bodies: Dict[Optional[int], bytes] = {}
+        self._lock = Lock()
+
+    def files(self) -> List[str]:
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if mtime_ns != self._mtime_ns:
+                # scandir's d_type answers is_file() without a stat per entry
+                with os.scandir(self.directory) as it:
+                    files = [e.name for e in it if e.name.lower().endswith('.md') and e.is_file()]
+                # Saves still in CHAT_IO_POOL are listed before they reach the disk
+                files.extend(name for name in self._pending if name not in files)
+                files.sort()
+                self._set_files(files, mtime_ns)
+            return self._files
+
+    def _set_files(self, files: List[str], mtime_ns: Optional[int]):
+        self._files = files
+        self._mtime_ns = mtime_ns
+        self._bodies = {}
+
+    def listing(self, limit: Optional[int] = None) -> bytes:
+        """The /api/chats body: every chat, or the newest limit of them, oldest first."""
+        files = self.files()
+        body = self._bodies.get(limit)
+        if body is None:
+            # Keep the oldest -> newest order of the full listing
+            body = orjson.dumps({'files': files if limit is None else heapq.nlargest(limit, files)[::-1]})
+            with self._lock:
+                # Rendered from files; only keep it if the index has not moved on since. Clients
+                # use one or two limits, so a few slots stop arbitrary ?limit= values piling up.
+                if self._files is files and len(self._bodies) < 8:
+                    self._bodies[limit] = body
+        return body
+
+    def recent(self, n: int) -> List[str]:
+        """The n newest chats, newest first. Names carry a sortable timestamp, so name order is age order."""
+        return heapq.nlargest(n, self.files())
+
+    def _settle(self, fname: str, future: Future):
+        error = future.exception()
+        with self._lock:
+            # A later save of the same chat may already be queued behind this one
+            if self._pending.get(fname) is future:
+                del self._pending[fname]
+            if error is not None:
+                # The listing already names the file; force a rescan so it drops out
+                self._mtime_ns = None
+        if error is not None:
+            logger.log('ERROR', 'Failed to save chat', None, filename=fname, error=str(error))
+
+    def wait(self, fname: str):
+        """Block until a queued save of fname has been written."""
+        pending = self._pending.get(fname)
+        if pending is not None:
+            pending.exception()
+
+    def add(self, fname: str, pending: Optional[Future] = None):
+        with self._lock:
+            if pending is not None:
+                self._pending[fname] = pending
+            if self._mtime_ns is not None:
+                # Copy on write: a list already handed out by files() is never mutated
+                files = list(self._files)
+                if fname not in files:
+                    bisect.insort(files, fname)
+                self._set_files(files, os.stat(self.directory).st_mtime_ns)
+        if pending is not None:
+            # Registered outside the lock: a save that already finished settles right here
+            pending.add_done_callback(lambda future: self._settle(fname, future))
+
+chat_index = ChatIndex(CHATS_DIR)
+
 @app.route('/api/chats', methods=['GET'])
 @log_request
 def list_chats():
-    files = []
-    for fname in sorted(os.listdir(CHATS_DIR)):
-        if fname.lower().endswith('.md'):
-            files.append(fname)
-    return jsonify({'files': files})
+    limit = request.args.get('limit')
+    try:
+        n = None if limit is None else max(int(limit), 0)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    # The sidebar polls this; an unchanged index answers with the body it rendered last time
+    return Response(chat_index.listing(n), mimetype='application/json')
 
 @app.route('/api/chats/<path:filename>', methods=['GET'])
 @log_request
 def get_chat(filename):
     safe = os.path.basename(filename)
-    path = os.path.join(CHATS_DIR, safe)
+    try:
+        path = safe_path(os.path.join(CHATS_DIR, safe), CHATS_ROOT)
+    except ValueError:
+        return jsonify({'error': 'Not found'}), 404
+    chat_index.wait(safe)
     if not os.path.exists(path):
         return jsonify({'error': 'Not found'}), 404
-    with open(path, 'r', encoding='utf-8') as f:
+    with open(path, 'r', encoding='utf-8', buffering=IO_BUF) as f:
         content = f.read()
     return jsonify({'filename': safe, 'content': content})
 
 @app.route('/api/save_chat', methods=['POST'])
 @log_request
 def save_chat():
-    data = request.get_json(force=True)
-    md_content = data.get('markdown', '').strip()
-    if not md_content:
+    body = decode_body(SaveChatBody)
+    md_content = body.markdown
+    # isspace() stops at the first visible character, and strip() copies the whole
+    # payload, so only copy when there is actually surrounding whitespace to drop
+    if not md_content or md_content.isspace():
         return jsonify({'error': 'No markdown content provided'}), 400
-
-    ts = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    fname = f"chat_{ts}.md"
-    path = os.path.join(CHATS_DIR, fname)
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(md_content)
+    if md_content[0].isspace() or md_content[-1].isspace():
+        md_content = md_content.strip()
+
+    if not _chat_save_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many chat saves in progress, try again shortly'}), 503, {'Retry-After': '1'}
+    content = md_content.encode('utf-8')
+    state = assistant.get_session(get_session_id(body.session_id))
+    # Saves of one session are ordered; other sessions hash and queue theirs meanwhile
+    with state._chat_lock:
+        # A session saves into one file. The client sends the whole transcript each time,
+        # so when it still starts with what was saved last only the new tail is written.
+        # Anything else is another conversation (New Chat keeps the session) and gets a file
+        # of its own, so a saved transcript is never overwritten.
+        saved_file, saved_length, saved_digest = state.saved_chat()
+        view = memoryview(content)
+        offset = hashed = 0
+        digest = hashlib.blake2b(digest_size=16)
+        if saved_file is not None and not body.new_chat and len(content) >= saved_length:
+            digest.update(view[:saved_length])
+            hashed = saved_length
+            if digest.hexdigest() == saved_digest:
+                offset = saved_length
+        digest.update(view[hashed:])
+        if offset:
+            fname = saved_file
+            # Only this process's own queued write of that file is there to wait for
+            previous = state.chat_write if state.chat_file == fname else None
+        else:
+            try:
+                fname = _create_chat_file(state.session_id)
+            except OSError as e:
+                _chat_save_slots.release()
+                return jsonify({'error': f'Failed to save chat: {e}'}), 500
+            previous = None
+        write = CHAT_IO_POOL.submit(_write_chat, os.path.join(CHATS_DIR, fname), content, offset, previous)
+        state.record_chat(fname, len(content), digest.hexdigest())
+        state.chat_write = write
+    write.add_done_callback(lambda _: _chat_save_slots.release())
+    chat_index.add(fname, write)
     return jsonify({'ok': True, 'filename': fname})
 
 if __name__ == '__main__':
-    # Reset message history on start
-    assistant.messages = [assistant.messages[0]] 
     port = int(os.getenv('PORT', '5051'))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,28 @@
+# Gunicorn settings for the container (CMD runs `gunicorn -c gunicorn.conf.py app:app`).
+#
+# The app is I/O bound: a request mostly waits on OpenRouter, Redis or the disk, all
+# of which release the GIL. gthread workers therefore multiplex many in-flight model
+# streams per process, and each SSE stream holds one thread for its lifetime, so
+# workers * threads is the ceiling on concurrent streams.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5051')}"
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+# With gthread, timeout only bounds the worker's heartbeat (its main loop keeps beating while
+# threads stream), so it does not cap a reply; on a graceful restart streams get as long to finish
+timeout = 120
+graceful_timeout = 120
+
+# nginx keeps idle upstream connections (keepalive 32) for its 60s keepalive_timeout.
+# Outlast that so nginx is always the side that closes them, never a request in flight
+keepalive = 75
+
+# Worker heartbeats go to tmpfs instead of the container's overlay filesystem
+worker_tmp_dir = '/dev/shm'
+
+# No preload_app: the logger and metrics flush threads start at import and would not
+# survive the fork into the workers
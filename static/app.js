@@ -17,6 +17,19 @@ const fileModalTitle = document.getElementById('fileModalTitle');
 const fileModalContent = document.getElementById('fileModalContent');
 const closeFileModal = document.getElementById('closeFileModal');
 
+// Conversation state is kept per session on the server; one id per browser tab.
+// crypto.randomUUID only exists in secure contexts, and the UI is also served over plain HTTP.
+function newSessionId() {
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  if (window.crypto && crypto.getRandomValues) {
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+  }
+  return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+const SESSION_ID = sessionStorage.getItem('sessionId') || newSessionId();
+sessionStorage.setItem('sessionId', SESSION_ID);
+const JSON_HEADERS = { 'Content-Type': 'application/json', 'X-Session-ID': SESSION_ID };
+
 marked.setOptions({
   breaks: true,
   highlight: function(code, lang) {
@@ -145,14 +158,14 @@ function createConfirmationPrompt(action) {
       if (toolName === 'replace_code') {
         resp = await fetch('/api/preview_replace_diff', {
           method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
+          headers: DIFF_HEADERS,
           body: JSON.stringify({
             filename: toolArgs.filename,
             old_code: toolArgs.old_code,
             new_code: toolArgs.new_code,
           })
         });
-        const data = await resp.json();
+        const data = await readDiffResponse(resp);
         if (data.ok) {
           showDiff(data.file_diff);
         } else {
@@ -161,13 +174,13 @@ function createConfirmationPrompt(action) {
       } else if (toolName === 'write_file') {
         resp = await fetch('/api/preview_write_diff', {
           method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
+          headers: DIFF_HEADERS,
           body: JSON.stringify({
             filename: toolArgs.filename,
             content: toolArgs.content,
           })
         });
-        const data = await resp.json();
+        const data = await readDiffResponse(resp);
         if (data.ok) {
           showDiff(data.file_diff);
         } else {
@@ -211,6 +224,43 @@ function showThinking(show = true) {
   }
 }
 
+// Diff previews stream as NDJSON frames of lines; errors still come back as plain JSON
+const DIFF_HEADERS = { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson, application/json' };
+
+async function readDiffResponse(res) {
+  if (!(res.headers.get('Content-Type') || '').startsWith('application/x-ndjson')) {
+    return res.json();
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  const diffs = {};
+  let buffered = '';
+  let ok = false;
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    // Frames can be split across reads; keep the trailing partial line for the next one
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
+    for (const line of lines) {
+      if (!line) continue;
+      const frame = JSON.parse(line);
+      if (frame.type === 'end') {
+        ok = frame.ok;
+      } else {
+        (diffs[frame.type] = diffs[frame.type] || []).push(...frame.lines);
+      }
+    }
+  }
+  const data = { ok };
+  for (const name of ['snippet_diff', 'file_diff']) {
+    data[name] = (diffs[name] || []).join('\n');
+  }
+  if (!ok) data.error = 'Diff stream ended early';
+  return data;
+}
+
 function showDiff(diffText) {
   // Convert diff text to diff2html format
   const diffHtml = Diff2Html.html(diffText, {
@@ -234,11 +284,14 @@ async function executeConfirmedAction(action) {
   try {
     const res = await fetch('/api/execute_action', {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers: { ...JSON_HEADERS, 'Accept': 'text/event-stream' },
       body: JSON.stringify(action)
     });
-    const data = await res.json();
-    handleApiResponse(data);
+    if ((res.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+      await renderEventStream(res);
+    } else {
+      handleApiResponse(await res.json());
+    }
   } catch(e) {
     createMessage('assistant', `Network error while executing action: ${e.message}`);
   } finally {
@@ -258,6 +311,53 @@ function handleApiResponse(data) {
   }
 }
 
+// Render a server-sent event stream of {type: content|tool_call|complete} events
+async function renderEventStream(res) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let streamingContent = createStreamingMessage();
+  let fullResponse = '';
+  let buffered = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    // Events can be split across reads; keep the trailing partial line for the next one
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
+
+    for (const line of lines) {
+      if (line.startsWith('data: ')) {
+        const data = line.slice(6);
+        if (data === '[DONE]') return;
+
+        try {
+          const parsed = JSON.parse(data);
+          if (parsed.type === 'content') {
+            fullResponse += parsed.content;
+            streamingContent.innerHTML = marked.parse(fullResponse);
+            enhanceCodeBlocks(streamingContent);
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+          } else if (parsed.type === 'tool_call') {
+            handleApiResponse({ action_request: parsed.tool_call });
+            return;
+          } else if (parsed.type === 'complete') {
+            handleApiResponse({ reply: parsed.reply });
+            return;
+          } else if (parsed.error) {
+            handleApiResponse(parsed);
+            return;
+          }
+        } catch (e) {
+          // Ignore parse errors
+        }
+      }
+    }
+  }
+}
+
 async function sendMessage() {
   const text = input.value.trim();
   if (!text) return;
@@ -270,53 +370,17 @@ async function sendMessage() {
     // Try streaming first
     const res = await fetch('/api/chat/stream', {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers: JSON_HEADERS,
       body: JSON.stringify({ message: text })
     });
 
     if (res.ok) {
-      const reader = res.body.getReader();
-      const decoder = new TextDecoder();
-      let streamingContent = createStreamingMessage();
-      let fullResponse = '';
-
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
-
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            const data = line.slice(6);
-            if (data === '[DONE]') break;
-
-            try {
-              const parsed = JSON.parse(data);
-              if (parsed.type === 'content') {
-                fullResponse += parsed.content;
-                streamingContent.innerHTML = marked.parse(fullResponse);
-                enhanceCodeBlocks(streamingContent);
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-              } else if (parsed.type === 'tool_call') {
-                handleApiResponse({ action_request: parsed.tool_call });
-                break;
-              } else if (parsed.type === 'complete') {
-                handleApiResponse({ reply: parsed.reply });
-                break;
-              }
-            } catch (e) {
-              // Ignore parse errors
-            }
-          }
-        }
-      }
+      await renderEventStream(res);
     } else {
       // Fallback to non-streaming
       const res2 = await fetch('/api/chat', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: JSON_HEADERS,
         body: JSON.stringify({ message: text })
       });
       const data = await res2.json();
@@ -331,10 +395,10 @@ async function sendMessage() {
 
 async function loadProjectTree() {
   try {
-    const sessionId = 'default'; // You can generate unique session IDs if needed
+    const sessionId = SESSION_ID;
     const timestamp = Date.now(); // Cache busting
     const version = 'v2'; // Version parameter to force cache refresh
-    const url = `/api/tree?session_id=${sessionId}&t=${timestamp}&v=${version}`;
+    const url = `/api/tree?session_id=${sessionId}&layout=columns&t=${timestamp}&v=${version}`;
     
     console.log('Fetching tree from:', url);
     console.log('Current time:', new Date().toISOString());
@@ -359,12 +423,12 @@ async function loadProjectTree() {
     
     console.log('Raw API response:', data);
     console.log('Type of data:', typeof data);
-    console.log('Type of data.tree:', typeof data.tree);
-    console.log('Is data.tree an array?', Array.isArray(data.tree));
-    console.log('data.tree value:', data.tree);
+    console.log('Type of data.names:', typeof data.names);
+    console.log('Is data.names an array?', Array.isArray(data.names));
+    console.log('data.names value:', data.names);
     
-    if (data.tree && Array.isArray(data.tree)) {
-      console.log('Processing tree with', data.tree.length, 'items');
+    if (data.names && Array.isArray(data.names)) {
+      console.log('Processing tree with', data.names.length, 'items');
       projectTree.innerHTML = '';
       
       // Add current path display
@@ -383,29 +447,13 @@ async function loadProjectTree() {
       }
       
       // Add directories and files
-      data.tree.forEach((item, index) => {
-        console.log(`Processing item ${index}:`, item);
-        const treeItem = document.createElement('div');
-        treeItem.className = 'tree-item';
-        
-        if (item.type === 'directory') {
-          treeItem.classList.add('folder');
-          treeItem.innerHTML = `📁 ${item.name}`;
-          treeItem.onclick = () => navigateToDirectory(item.path);
-        } else {
-          treeItem.classList.add('file');
-          treeItem.innerHTML = `📄 ${item.name}`;
-          treeItem.onclick = () => openFilePreview(item.path);
-        }
-        
-        projectTree.appendChild(treeItem);
-      });
+      appendTreePage(data);
       
       console.log('Tree loaded successfully');
     } else {
       console.error('Invalid tree data:', data);
-      console.error('data.tree type:', typeof data.tree);
-      console.error('data.tree value:', data.tree);
+      console.error('data.names type:', typeof data.names);
+      console.error('data.names value:', data.names);
       projectTree.innerHTML = '<div class="error">Invalid tree data received</div>';
     }
   } catch (e) {
@@ -415,9 +463,47 @@ async function loadProjectTree() {
   }
 }
 
+// Pages are requested with layout=columns: parallel names/types/paths arrays
+function appendTreePage(data) {
+  const { names, types, paths } = data;
+  for (let i = 0; i < names.length; i++) {
+    const treeItem = document.createElement('div');
+    treeItem.className = 'tree-item';
+    const path = paths[i];
+    
+    if (types[i] === 'directory') {
+      treeItem.classList.add('folder');
+      treeItem.innerHTML = `📁 ${names[i]}`;
+      treeItem.onclick = () => navigateToDirectory(path);
+    } else {
+      treeItem.classList.add('file');
+      treeItem.innerHTML = `📄 ${names[i]}`;
+      treeItem.onclick = () => openFilePreview(path);
+    }
+    
+    projectTree.appendChild(treeItem);
+  }
+  
+  // Large directories come in pages; fetch the next one on demand
+  if (data.truncated) {
+    const nextOffset = data.offset + names.length;
+    const moreItem = document.createElement('div');
+    moreItem.className = 'tree-item more-link';
+    moreItem.textContent = `… ${data.total - nextOffset} more`;
+    moreItem.onclick = async () => {
+      const res = await fetch(`/api/tree?session_id=${SESSION_ID}&layout=columns&offset=${nextOffset}`);
+      if (res.ok) {
+        projectTree.removeChild(moreItem);
+        appendTreePage(await res.json());
+      }
+    };
+    projectTree.appendChild(moreItem);
+  }
+}
+
 async function navigateToDirectory(path) {
   try {
-    const sessionId = 'default';
+    const sessionId = SESSION_ID;
     const res = await fetch('/api/change_directory', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
@@ -444,7 +530,7 @@ async function navigateToDirectory(path) {
 
 async function updateAIAssistantContext() {
   try {
-    const sessionId = 'default';
+    const sessionId = SESSION_ID;
     const res = await fetch(`/api/current_directory?session_id=${sessionId}`);
     const data = await res.json();
     
@@ -458,10 +544,9 @@ async function updateAIAssistantContext() {
 
 async function openFilePreview(filename) {
   try {
-    const res = await fetch(`/api/file?path=${encodeURIComponent(filename)}`);
-    const data = await res.json();
-    if (data.content) {
-      showFileModal(filename, data.content);
+    const res = await fetch(`/api/file?path=${encodeURIComponent(filename)}&raw=1`);
+    if (res.ok) {
+      showFileModal(filename, await res.text());
     } else {
       alert('Failed to load file content');
     }
@@ -521,6 +606,8 @@ input.addEventListener('keydown', (e) => {
 
 newChatBtn.addEventListener('click', () => {
   chatContainer.innerHTML = '';
+  chatStartedAt = new Date();
+  newChatPending = true;
   createMessage('assistant', 'Hello! I\'m your AI coding assistant. I can help you with:\n\n• Reading and editing files\n• Searching through code\n• Creating new files and directories\n• Running commands\n• Navigating your project structure\n\nWhat would you like to work on today?');
 });
 
@@ -595,10 +682,15 @@ function enhanceCodeBlocks(scopeEl) {
   });
 }
 
+// The transcript header is fixed per chat, so saving again only adds to what the server
+// has; New Chat starts its transcript in a file of its own
+let chatStartedAt = new Date();
+let newChatPending = false;
+
 async function saveChat() {
   const blocks = chatContainer.querySelectorAll('.message');
   const lines = [];
-  lines.push(`# Chat Transcript - ${new Date().toLocaleString()}`);
+  lines.push(`# Chat Transcript - ${chatStartedAt.toLocaleString()}`);
   lines.push('');
   blocks.forEach(b => {
     const isUser = b.classList.contains('user');
@@ -613,15 +705,17 @@ async function saveChat() {
     }
   });
 
-  const md = lines.join('\n');
+  // Trimmed here so the server can store the payload without copying it
+  const md = lines.join('\n').trim();
   try {
     const res = await fetch('/api/save_chat', {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ markdown: md })
+      headers: JSON_HEADERS,
+      body: JSON.stringify({ markdown: md, new_chat: newChatPending })
     });
     const data = await res.json();
     if (data.ok) {
+      newChatPending = false;
       await loadChatList();
       alert(`Saved as ${data.filename}`);
     } else {
@@ -636,7 +730,7 @@ saveChatBtn.addEventListener('click', saveChat);
 
 async function loadChatList() {
   try {
-    const res = await fetch('/api/chats');
+    const res = await fetch('/api/chats?limit=50');
     const data = await res.json();
     chatList.innerHTML = '';
     data.files.reverse().forEach(f => {
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(autouse=True, scope='session')
+def runtime_files(tmp_path_factory):
+    """Keep the request log and saved chats of a test run out of the working tree."""
+    import app as app_module
+    directory = tmp_path_factory.mktemp('runtime')
+    chats = directory / 'chats'
+    chats.mkdir()
+    logger = app_module.logger
+    log_file = str(directory / 'app.log')
+    fp = open(log_file, 'ab', buffering=1 << 16)
+    with logger._write_lock:
+        saved = logger.log_file, logger._fp
+        logger.log_file, logger._fp = log_file, fp
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app_module, 'CHATS_DIR', str(chats))
+        mp.setattr(app_module, 'CHATS_ROOT', os.path.realpath(chats))
+        mp.setattr(app_module, 'chat_index', app_module.ChatIndex(str(chats)))
+        yield directory
+    logger._drain()
+    with logger._write_lock:
+        logger.log_file, logger._fp = saved
+    fp.close()
@@ -2,6 +2,8 @@ import pytest
 import json
 import tempfile
 import os
+import time
+from datetime import datetime
 from app import app
 
 class TestFlaskEndpoints:
@@ -23,6 +25,30 @@ class TestFlaskEndpoints:
         assert data['status'] == 'healthy'
         assert 'timestamp' in data
     
+    def test_index_accel_redirect(self, client):
+        """Test that the index is handed to nginx when it advertises an internal prefix."""
+        direct = client.get('/')
+        assert direct.status_code == 200
+        assert b'<html' in direct.data.lower()
+        
+        proxied = client.get('/', headers={'X-Accel-Prefix': '/internal/'})
+        assert proxied.headers['X-Accel-Redirect'] == '/internal/static/index.html'
+        assert proxied.data == b''
+    
+    def test_index_links_current_asset_digests(self, client):
+        """Test that index.html links every asset by its current digest and those URLs are immutable."""
+        import re
+        from app import STATIC_DIGESTS
+        html = client.get('/').data.decode()
+        linked = dict(re.findall(r'"/([\w.]+\.(?:js|css))\?v=(\w+)"', html))
+        assert linked == STATIC_DIGESTS, "update the ?v= digests in static/index.html"
+        
+        versioned = client.get(f"/app.js?v={STATIC_DIGESTS['app.js']}")
+        assert 'immutable' in versioned.headers['Cache-Control']
+        stale = client.get('/app.js?v=old')
+        assert 'immutable' not in stale.headers.get('Cache-Control', '')
+        assert stale.headers['ETag']
+    
     def test_metrics_endpoint(self, client):
         """Test the Prometheus metrics endpoint."""
         response = client.get('/metrics')
@@ -45,6 +71,10 @@ class TestFlaskEndpoints:
                              json={'message': 'Hello'})
         assert response.status_code == 200
         assert response.headers['Content-Type'] == 'text/event-stream'
+        assert response.headers['X-Accel-Buffering'] == 'no'
+        assert response.headers['Cache-Control'] == 'no-cache'
+        # Closing ends the stream, which releases the session the way a finished request does
+        response.close()
     
     def test_preview_replace_diff_endpoint(self, client):
         """Test the diff preview endpoint for replace operations."""
@@ -64,9 +94,35 @@ class TestFlaskEndpoints:
             data = json.loads(response.data)
             assert data['ok'] == True
             assert 'file_diff' in data
+            
+            response = client.post('/api/preview_replace_diff', 
+                                 json={
+                                     'filename': temp_file,
+                                     'old_code': 'Goodbye World',
+                                     'new_code': 'Hello Universe'
+                                 })
+            data = json.loads(response.data)
+            assert data['ok'] == False
+            assert 'not found' in data['error']
         finally:
             os.unlink(temp_file)
     
+    def test_preview_replace_diff_whole_lines(self, client, tmp_path):
+        """Test that a whole-line replacement diffs the file the same way difflib does."""
+        import difflib
+        original = ''.join(f'line {i}\n' for i in range(40))
+        old_code = 'line 20\nline 21\n'
+        new_code = 'line 20\nchanged\nline 21b\n'
+        path = tmp_path / 'big.txt'
+        path.write_text(original)
+        
+        response = client.post('/api/preview_replace_diff',
+                               json={'filename': str(path), 'old_code': old_code, 'new_code': new_code})
+        data = json.loads(response.data)
+        expected = difflib.unified_diff(original.splitlines(), original.replace(old_code, new_code).splitlines(),
+                                        fromfile=f'{path}:original', tofile=f'{path}:preview', lineterm='')
+        assert data['file_diff'] == '\n'.join(expected)
+    
     def test_preview_write_diff_endpoint(self, client):
         """Test the diff preview endpoint for write operations."""
         # Create a temporary file for testing
@@ -87,6 +143,72 @@ class TestFlaskEndpoints:
         finally:
             os.unlink(temp_file)
     
+    def test_replace_preview_matches_replace_code(self, client, tmp_path):
+        """Test that the preview shows every occurrence replaced and indented as the tool writes it."""
+        import difflib
+        from app import assistant
+        original = 'def a():\n    x = 1\n\ndef b():\n    x = 1\n'
+        target = tmp_path / 'twice.py'
+        target.write_text(original)
+        data = client.post('/api/preview_replace_diff',
+                           json={'filename': str(target), 'old_code': '    x = 1\n', 'new_code': 'x = 2\n'}).get_json()
+        
+        assert assistant.replace_code(str(target), '    x = 1\n', 'x = 2\n').startswith('Successfully')
+        written = target.read_text()
+        assert written == 'def a():\n    x = 2\n\ndef b():\n    x = 2\n'
+        expected = difflib.unified_diff(original.splitlines(), written.splitlines(),
+                                        fromfile=f'{target}:original', tofile=f'{target}:preview', lineterm='')
+        assert data['file_diff'] == '\n'.join(expected)
+    
+    def test_preview_streams_ndjson_when_asked(self, client, tmp_path, monkeypatch):
+        """Test that NDJSON previews carry the same diffs as the JSON form, batched into frames."""
+        import app as app_module
+        target = tmp_path / 'stream.txt'
+        target.write_text(''.join(f'line {i}\n' for i in range(20)))
+        body = {'filename': str(target), 'old_code': 'line 5\n', 'new_code': 'five\n'}
+        expected = client.post('/api/preview_replace_diff', json=body).get_json()
+        
+        monkeypatch.setattr(app_module, 'DIFF_STREAM_BATCH', 3)
+        response = client.post('/api/preview_replace_diff', json=body, headers={'Accept': 'application/x-ndjson'})
+        assert response.mimetype == 'application/x-ndjson'
+        frames = [json.loads(line) for line in response.data.splitlines()]
+        assert frames[-1] == {'type': 'end', 'ok': True}
+        assert all(len(frame['lines']) <= 3 for frame in frames[:-1])
+        for name in ('snippet_diff', 'file_diff'):
+            lines = [line for frame in frames if frame['type'] == name for line in frame['lines']]
+            assert '\n'.join(lines) == expected[name]
+    
+    def test_unedited_previews_are_empty(self, client, tmp_path):
+        """Test that previews of no-op edits return empty diffs."""
+        target = tmp_path / 'same.txt'
+        target.write_text('alpha\nbeta\n')
+        data = client.post('/api/preview_replace_diff',
+                           json={'filename': str(target), 'old_code': 'alp', 'new_code': 'alp'}).get_json()
+        assert data == {'ok': True, 'snippet_diff': '', 'file_diff': ''}
+        data = client.post('/api/preview_write_diff', json={'filename': str(target), 'content': 'alpha\nbeta\n'}).get_json()
+        assert data == {'ok': True, 'file_diff': ''}
+        
+        # Only line breaks differ, so the snippet diff is empty, yet dropping one joins two file lines
+        data = client.post('/api/preview_replace_diff',
+                           json={'filename': str(target), 'old_code': 'alpha\n', 'new_code': 'alpha'}).get_json()
+        assert data['snippet_diff'] == '' and '+alphabeta' in data['file_diff'].splitlines()
+        target.write_text('a\u2028b\nc\n')
+        data = client.post('/api/preview_replace_diff',
+                           json={'filename': str(target), 'old_code': 'a\u2028b\n', 'new_code': 'a\nb\n'}).get_json()
+        assert data == {'ok': True, 'snippet_diff': '', 'file_diff': ''}
+    
+    def test_structured_write_matches_preview(self, client, tmp_path):
+        """Test that dict content is written exactly as the write preview renders it."""
+        from app import assistant
+        target = str(tmp_path / 'config.json')
+        content = {'name': 'caf\u00e9', 'items': [1, 2]}
+        data = client.post('/api/preview_write_diff', json={'filename': target, 'content': content}).get_json()
+        added = [line[1:] for line in data['file_diff'].splitlines() if line.startswith('+') and not line.startswith('+++')]
+        
+        assistant.write_file(target, content)
+        with open(target, encoding='utf-8') as f:
+            assert f.read().splitlines() == added
+    
     def test_tree_endpoint(self, client):
         """Test the project tree endpoint."""
         response = client.get('/api/tree')
@@ -94,6 +216,69 @@ class TestFlaskEndpoints:
         data = json.loads(response.data)
         assert 'tree' in data
     
+    def test_tree_endpoint_sees_new_files(self, client, tmp_path):
+        """Test that a cached listing is rebuilt once the directory changes."""
+        client.post('/api/change_directory', json={'session_id': 'tree-cache', 'directory': str(tmp_path)})
+        (tmp_path / 'first.txt').write_text('1')
+        names = lambda: [item['name'] for item in client.get('/api/tree?session_id=tree-cache').get_json()['tree']]
+        assert names() == ['first.txt']
+        
+        (tmp_path / 'second.txt').write_text('2')
+        os.utime(tmp_path, ns=(0, os.stat(tmp_path).st_mtime_ns + 1))
+        assert names() == ['first.txt', 'second.txt']
+    
+    def test_tree_endpoint_pages(self, client, tmp_path):
+        """Test that limit/offset page through a directory listing."""
+        for name in ('b.txt', 'a.txt', 'c.txt'):
+            (tmp_path / name).write_text(name)
+        (tmp_path / 'sub').mkdir()
+        client.post('/api/change_directory', json={'session_id': 'tree-pages', 'directory': str(tmp_path)})
+        
+        first = client.get('/api/tree?session_id=tree-pages&limit=2').get_json()
+        assert [item['name'] for item in first['tree']] == ['sub', 'a.txt']
+        assert first['truncated'] and first['total'] == 4
+        
+        rest = client.get('/api/tree?session_id=tree-pages&limit=2&offset=2').get_json()
+        assert [item['name'] for item in rest['tree']] == ['b.txt', 'c.txt']
+        assert not rest['truncated']
+        assert client.get('/api/tree?session_id=tree-pages&limit=x').status_code == 400
+    
+    def test_tree_columns_layout(self, client, tmp_path):
+        """Test that layout=columns returns the same page as parallel arrays."""
+        (tmp_path / 'b.txt').write_text('b')
+        (tmp_path / 'sub').mkdir()
+        client.post('/api/change_directory', json={'session_id': 'tree-columns', 'directory': str(tmp_path)})
+        rows = client.get('/api/tree?session_id=tree-columns').get_json()
+        columns = client.get('/api/tree?session_id=tree-columns&layout=columns').get_json()
+        assert 'tree' not in columns
+        assert columns['names'] == [item['name'] for item in rows['tree']] == ['sub', 'b.txt']
+        assert columns['types'] == ['directory', 'file']
+        assert columns['paths'] == [item['path'] for item in rows['tree']]
+        assert columns['total'] == rows['total'] == 2
+    
+    def test_change_directory_confined_to_root(self, client, tmp_path, monkeypatch):
+        """Test that sessions cannot browse above the file root."""
+        import functools
+        import app as app_module
+        root = tmp_path / 'root'
+        (root / 'sub').mkdir(parents=True)
+        monkeypatch.setattr(app_module, 'safe_path', functools.partial(app_module.safe_path.__wrapped__, root=str(root)))
+        
+        response = client.post('/api/change_directory', json={'session_id': 'confined', 'directory': str(root / 'sub' / '..')})
+        assert response.get_json() == {'success': True, 'current_path': str(root)}
+        response = client.post('/api/change_directory', json={'session_id': 'confined', 'directory': str(tmp_path)})
+        assert response.status_code == 403
+    
+    def test_tree_early_page_of_large_directory(self, client, tmp_path):
+        """Test that an early page of a large directory matches the fully sorted listing."""
+        names = [f'File{i:02d}.txt' if i % 2 else f'file{i:02d}.txt' for i in range(40)]
+        for name in names:
+            (tmp_path / name).write_text('')
+        client.post('/api/change_directory', json={'session_id': 'tree-large', 'directory': str(tmp_path)})
+        page = client.get('/api/tree?session_id=tree-large&limit=3&offset=3').get_json()
+        assert [item['name'] for item in page['tree']] == sorted(names, key=str.lower)[3:6]
+        assert page['total'] == 40 and page['truncated']
+    
     def test_file_endpoint(self, client):
         """Test the file content endpoint."""
         # Create a temporary file for testing
@@ -110,6 +295,25 @@ class TestFlaskEndpoints:
         finally:
             os.unlink(temp_file)
     
+    def test_file_endpoint_raw(self, client):
+        """Test that raw=1 streams the file as text with conditional request support."""
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as f:
+            f.write('Raw file content')
+            temp_file = f.name
+        
+        try:
+            response = client.get(f'/api/file?path={temp_file}&raw=1')
+            assert response.status_code == 200
+            assert response.mimetype == 'text/plain'
+            assert response.data == b'Raw file content'
+            assert response.headers['Content-Disposition'] == f'inline; filename={os.path.basename(temp_file)}'
+            
+            cached = client.get(f'/api/file?path={temp_file}&raw=1',
+                                headers={'If-None-Match': response.headers['ETag']})
+            assert cached.status_code == 304
+        finally:
+            os.unlink(temp_file)
+    
     def test_file_endpoint_not_found(self, client):
         """Test the file endpoint with non-existent file."""
         response = client.get('/api/file?path=nonexistent.txt')
@@ -125,8 +329,61 @@ class TestFlaskEndpoints:
         assert response.status_code == 200
         data = json.loads(response.data)
         assert 'reply' in data or 'error' in data
+        # The turn lock is released when the response closes, as the server does after sending it
+        response.close()
+    
+    def test_execute_action_streams_when_asked(self, client, monkeypatch):
+        """Test that execute_action relays model deltas as SSE when the client accepts it."""
+        import app as app_module
+        
+        class FakeModelResponse:
+            def iter_content(self, chunk_size=None):
+                yield b'data: {"choices": [{"delta": {"content": "Hel"}}]}\n\ndata: {"choices": '
+                yield b'[{"delta": {"content": "lo"}}]}\n\n'
+                yield b'data: [DONE]\n\n'
+        
+        monkeypatch.setattr(app_module.assistant, '_execute_model_call',
+                            lambda request_id, state: (FakeModelResponse(), None))
+        response = client.post('/api/execute_action',
+                               json={'name': 'list_files', 'args': {}},
+                               headers={'Accept': 'text/event-stream', 'X-Session-ID': 'sse-action'})
+        
+        assert response.content_type == 'text/event-stream'
+        events = [line[6:] for line in response.data.decode().split('\n\n') if line.startswith('data: ')]
+        assert [json.loads(e) for e in events[:-1]] == [
+            {'type': 'content', 'content': 'Hel'},
+            {'type': 'content', 'content': 'lo'},
+            {'type': 'complete'},
+        ]
+        assert events[-1] == '[DONE]'
+        assert app_module.assistant.get_session('sse-action').messages[-1] == {'role': 'assistant', 'content': 'Hello'}
+        response.close()
+        assert not app_module.session_lock('sse-action').locked()
     
-    def test_save_chat_endpoint(self, client):
+    def test_busy_session_is_rejected(self, client, monkeypatch):
+        """Test that a second turn in the same session waits for the first and then gives up."""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'SESSION_LOCK_TIMEOUT', 0.01)
+        lock = app_module.session_lock('busy-session')
+        with lock:
+            response = client.post('/api/chat', json={'message': 'hi'}, headers={'X-Session-ID': 'busy-session'})
+            assert response.status_code == 409
+            response = client.post('/api/execute_action', json={'name': 'list_files', 'args': {}},
+                                   headers={'X-Session-ID': 'busy-session'})
+            assert response.status_code == 409
+    
+    @pytest.fixture
+    def chats_dir(self, tmp_path, monkeypatch):
+        """Point chat saves at a throwaway directory instead of the repo's chats/."""
+        import app as app_module
+        directory = tmp_path / 'chats'
+        directory.mkdir()
+        monkeypatch.setattr(app_module, 'CHATS_DIR', str(directory))
+        monkeypatch.setattr(app_module, 'CHATS_ROOT', os.path.realpath(directory))
+        monkeypatch.setattr(app_module, 'chat_index', app_module.ChatIndex(str(directory)))
+        return directory
+    
+    def test_save_chat_endpoint(self, client, chats_dir):
         """Test the save chat endpoint."""
         response = client.post('/api/save_chat', 
                              json={
@@ -136,6 +393,86 @@ class TestFlaskEndpoints:
         data = json.loads(response.data)
         assert data['ok'] == True
         assert 'filename' in data
+        
+        response = client.get(f"/api/chats/{data['filename']}")
+        assert response.status_code == 200
+        assert json.loads(response.data)['content'].startswith('# Test Chat')
+    
+    def test_save_chat_appends_per_session(self, client, chats_dir):
+        """Test that a session appends to its file while the transcript grows, and that any other
+        transcript gets a file of its own."""
+        headers = {'X-Session-ID': 'save-session'}
+        def save(markdown, **extra):
+            return json.loads(client.post('/api/save_chat', json={'markdown': markdown, **extra}, headers=headers).data)
+        def read(fname):
+            return json.loads(client.get(f"/api/chats/{fname}").data)['content']
+        first = save('# Chat\n\nHello')
+        second = save('# Chat\n\nHello\n\nMore')
+        assert first['filename'] == second['filename']
+        assert read(second['filename']) == '# Chat\n\nHello\n\nMore'
+        
+        other = save('# Other')
+        assert other['filename'] != second['filename']
+        # New Chat starts over even when the new transcript happens to extend the last one
+        again = save('# Other\n\nAgain', new_chat=True)
+        assert len({second['filename'], other['filename'], again['filename']}) == 3
+        assert read(second['filename']) == '# Chat\n\nHello\n\nMore'
+        assert read(other['filename']) == '# Other'
+        assert read(again['filename']) == '# Other\n\nAgain'
+        # New files are written through a temporary file that never outlives the save
+        assert sorted(os.listdir(chats_dir)) == sorted([second['filename'], other['filename'], again['filename']])
+    
+    def test_save_chat_follows_session_across_workers(self, client, chats_dir, monkeypatch):
+        """Test that a save handled by another worker still extends the session's file."""
+        import app as app_module
+        hashes = {}
+        monkeypatch.setattr(app_module.redis_client, 'hgetall', lambda key: dict(hashes.get(key, {})))
+        monkeypatch.setattr(app_module.redis_client, 'hset',
+                            lambda key, mapping: hashes.setdefault(key, {}).update({k: str(v) for k, v in mapping.items()}))
+        headers = {'X-Session-ID': 'two-workers'}
+        first = json.loads(client.post('/api/save_chat', json={'markdown': '# Chat\n\nHello'}, headers=headers).data)
+        
+        # A worker that never saw this session: nothing about it in process memory
+        monkeypatch.setattr(app_module.assistant, 'session_memory', app_module.SessionStore())
+        second = json.loads(client.post('/api/save_chat', json={'markdown': '# Chat\n\nHello\n\nMore'},
+                                        headers=headers).data)
+        assert second['filename'] == first['filename']
+        assert json.loads(client.get(f"/api/chats/{first['filename']}").data)['content'] == '# Chat\n\nHello\n\nMore'
+        assert os.listdir(chats_dir) == [first['filename']]
+        
+        # The other worker's prefix is not on disk yet: the append falls back to a rewrite
+        pending = chats_dir / 'pending.md'
+        pending.write_bytes(b'')
+        app_module._write_chat(str(pending), b'# Chat\n\nHello', offset=len(b'# Chat'))
+        assert pending.read_bytes() == b'# Chat\n\nHello'
+    
+    def test_save_chat_names_are_unique_per_session(self, client, chats_dir, monkeypatch):
+        """Test that sessions saving within the same second never share a file."""
+        import app as app_module
+        class FrozenDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime(2024, 1, 2, 3, 4, 5, tzinfo=tz)
+        monkeypatch.setattr(app_module, 'datetime', FrozenDatetime)
+        # The last save is a second conversation of session a in that same second
+        saves = [('same-second-a', '# Chat a'), ('same-second-b', '# Chat b'), ('same-second-a', '# Next a')]
+        names = [json.loads(client.post('/api/save_chat', json={'markdown': markdown},
+                                        headers={'X-Session-ID': sid}).data)['filename']
+                 for sid, markdown in saves]
+        assert len(set(names)) == 3
+        assert all(name.startswith('chat_2024-01-02_03-04-05_') for name in names)
+        for (_, markdown), name in zip(saves, names):
+            assert json.loads(client.get(f'/api/chats/{name}').data)['content'] == markdown
+    
+    def test_save_chat_refused_when_saves_back_up(self, client, monkeypatch):
+        """Test that saves beyond the pending limit get a 503 instead of queueing."""
+        import threading
+        import app as app_module
+        monkeypatch.setattr(app_module, '_chat_save_slots', threading.BoundedSemaphore(1))
+        app_module._chat_save_slots.acquire()
+        response = client.post('/api/save_chat', json={'markdown': '# Chat'})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
     
     def test_list_chats_endpoint(self, client):
         """Test the list chats endpoint."""
@@ -145,6 +482,89 @@ class TestFlaskEndpoints:
         assert 'files' in data
         assert isinstance(data['files'], list)
 
+class TestSafePath:
+    """Test path canonicalisation for the file endpoints."""
+    
+    def test_paths_are_confined_to_root(self, tmp_path):
+        """Test that traversal and symlinks out of the root are rejected."""
+        from app import safe_path
+        root = str(tmp_path / 'root')
+        os.makedirs(os.path.join(root, 'sub'))
+        os.symlink(str(tmp_path), os.path.join(root, 'escape'))
+        
+        assert safe_path(os.path.join(root, 'sub', '..', 'a.txt'), root) == os.path.join(root, 'a.txt')
+        for name in (os.path.join(root, '..', 'a.txt'), os.path.join(root, 'escape', 'a.txt'), root + '-other'):
+            with pytest.raises(ValueError):
+                safe_path(name, root)
+    
+    def test_filesystem_root_allows_everything(self):
+        """Test that the default '/' root does not reject absolute paths."""
+        from app import safe_path
+        assert safe_path('/etc', '/') == os.path.realpath('/etc')
+
+class TestChatIndex:
+    """Test the cached chat listing."""
+    
+    def test_index_tracks_saves_and_external_files(self, tmp_path):
+        """Test that saved chats are inserted in order and outside changes trigger a rescan."""
+        from app import ChatIndex
+        (tmp_path / 'chat_b.md').write_text('b')
+        index = ChatIndex(str(tmp_path))
+        assert index.files() == ['chat_b.md']
+        
+        (tmp_path / 'chat_a.md').write_text('a')
+        index.add('chat_a.md')
+        assert index.files() == ['chat_a.md', 'chat_b.md']
+        
+        (tmp_path / 'chat_c.MD').write_text('c')
+        (tmp_path / 'notes.txt').write_text('x')
+        os.utime(tmp_path, ns=(0, os.stat(tmp_path).st_mtime_ns + 1))
+        assert index.files() == ['chat_a.md', 'chat_b.md', 'chat_c.MD']
+    
+    def test_recent_skips_directories(self, tmp_path):
+        """Test that only regular files are listed and recent() returns the newest first."""
+        from app import ChatIndex
+        for name in ('chat_1.md', 'chat_3.md', 'chat_2.md'):
+            (tmp_path / name).write_text(name)
+        (tmp_path / 'dir.md').mkdir()
+        index = ChatIndex(str(tmp_path))
+        assert index.files() == ['chat_1.md', 'chat_2.md', 'chat_3.md']
+        assert index.recent(2) == ['chat_3.md', 'chat_2.md']
+    
+    def test_listing_body_is_reused_until_index_changes(self, tmp_path):
+        """Test that the rendered /api/chats body is cached per limit and dropped on change."""
+        from app import ChatIndex
+        for name in ('chat_1.md', 'chat_2.md', 'chat_3.md'):
+            (tmp_path / name).write_text(name)
+        index = ChatIndex(str(tmp_path))
+        body = index.listing(2)
+        assert json.loads(body) == {'files': ['chat_2.md', 'chat_3.md']}
+        assert index.listing(2) is body
+        assert json.loads(index.listing()) == {'files': ['chat_1.md', 'chat_2.md', 'chat_3.md']}
+        
+        (tmp_path / 'chat_4.md').write_text('4')
+        index.add('chat_4.md')
+        assert json.loads(index.listing(2)) == {'files': ['chat_3.md', 'chat_4.md']}
+    
+    def test_queued_saves_are_listed_until_written(self, tmp_path):
+        """Test that a save still in flight is listed, waited on, and dropped if it fails."""
+        from concurrent.futures import Future
+        from app import ChatIndex
+        index = ChatIndex(str(tmp_path))
+        assert index.files() == []
+        
+        ok, failed = Future(), Future()
+        index.add('chat_1.md', ok)
+        index.add('chat_2.md', failed)
+        os.utime(tmp_path, ns=(0, os.stat(tmp_path).st_mtime_ns + 1))
+        assert index.files() == ['chat_1.md', 'chat_2.md']
+        
+        (tmp_path / 'chat_1.md').write_text('one')
+        ok.set_result(None)
+        index.wait('chat_1.md')
+        failed.set_exception(OSError('disk full'))
+        assert index.files() == ['chat_1.md']
+
 class TestErrorHandling:
     """Test error handling in endpoints."""
     
@@ -169,6 +589,12 @@ class TestErrorHandling:
         data = json.loads(response.data)
         assert 'error' in data
     
+    def test_blank_chat_save(self, client):
+        """Test that whitespace-only chats are rejected."""
+        response = client.post('/api/save_chat', json={'markdown': ' \n\t\n'})
+        assert response.status_code == 400
+        assert 'error' in json.loads(response.data)
+    
     def test_invalid_json(self, client):
         """Test handling of invalid JSON."""
         response = client.post('/api/chat', 
@@ -176,6 +602,15 @@ class TestErrorHandling:
                              content_type='application/json')
         assert response.status_code == 400
     
+    def test_mistyped_body_field(self, client):
+        """Test that a field of the wrong type is rejected by the body schema."""
+        response = client.post('/api/chat', json={'message': 5})
+        assert response.status_code == 400
+        assert '$.message' in json.loads(response.data)['error']
+        
+        response = client.post('/api/execute_action', json={'name': 'list_files', 'args': ['.']})
+        assert response.status_code == 400
+    
     def test_missing_tool_name(self, client):
         """Test handling of missing tool name in execute action."""
         response = client.post('/api/execute_action', 
@@ -184,6 +619,97 @@ class TestErrorHandling:
         data = json.loads(response.data)
         assert 'error' in data
 
+class TestFileTextCache:
+    """Test the stat-validated cache behind the previews and /api/file."""
+    
+    def test_hits_until_file_changes(self, tmp_path, monkeypatch):
+        """Test that an unchanged file is served from memory and a replaced one is re-read."""
+        import app as app_module
+        from app import FileTextCache
+        cache = FileTextCache()
+        path = tmp_path / 'a.txt'
+        path.write_text('one\n')
+        assert cache.read(str(path)) == 'one\n'
+        
+        opened = []
+        monkeypatch.setattr(app_module, 'open', lambda *a, **k: opened.append(a[0]) or open(*a, **k), raising=False)
+        assert cache.read(str(path)) == 'one\n'
+        assert opened == []
+        
+        replacement = tmp_path / 'b.txt'
+        replacement.write_text('two\n')
+        os.replace(replacement, path)
+        assert cache.read(str(path)) == 'two\n'
+        assert opened == [str(path)]
+    
+    def test_in_place_edit_is_not_served_stale(self, tmp_path):
+        """Test that an in-place same-size edit is re-read even when its stat key is unchanged."""
+        from app import assistant, file_text_cache
+        path = tmp_path / 'same.py'
+        path.write_text('x = 1\n')
+        assert file_text_cache.read(str(path)) == 'x = 1\n'
+        st = os.stat(path)
+        assert assistant.replace_code(str(path), 'x = 1', 'x = 2').startswith('Successfully')
+        # Pin mtime back: the edit landed within one timestamp tick, on the same inode and size
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert file_text_cache.read(str(path)) == 'x = 2\n'
+    
+    def test_lines_are_split_once(self, tmp_path):
+        """Test that repeated previews of an unchanged file reuse one splitlines() result."""
+        from app import FileTextCache
+        cache = FileTextCache()
+        path = tmp_path / 'a.txt'
+        path.write_text('one\ntwo\n')
+        assert cache.read(str(path)) == 'one\ntwo\n'
+        text, lines = cache.read_lines(str(path))
+        assert lines == ['one', 'two']
+        assert cache.read_lines(str(path))[1] is lines
+    
+    def test_concurrent_misses_share_one_read(self, tmp_path, monkeypatch):
+        """Test that simultaneous reads of a cold file open it once."""
+        import threading
+        import app as app_module
+        from app import FileTextCache
+        cache = FileTextCache()
+        path = tmp_path / 'cold.txt'
+        path.write_text('cold\n')
+        opened = []
+        
+        def slow_open(*args, **kwargs):
+            opened.append(args[0])
+            time.sleep(0.2)
+            return open(*args, **kwargs)
+        
+        monkeypatch.setattr(app_module, 'open', slow_open, raising=False)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.read(str(path)))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ['cold\n'] * 4
+        assert opened == [str(path)]
+    
+    def test_read_matches_text_mode(self, tmp_path):
+        """Test that small and mapped large files decode like a text-mode read."""
+        from app import FileTextCache, MMAP_MIN_SIZE
+        cache = FileTextCache()
+        for name, size in (('small.txt', 10), ('large.txt', MMAP_MIN_SIZE)):
+            path = tmp_path / name
+            path.write_bytes(('caf\u00e9\r\nline\rend\n' * size).encode('utf-8'))
+            with open(path, encoding='utf-8') as f:
+                assert cache.read(str(path)) == f.read()
+    
+    def test_evicts_past_byte_budget(self, tmp_path):
+        """Test that the oldest entries go once the byte budget is exceeded."""
+        from app import FileTextCache
+        cache = FileTextCache(max_bytes=40)
+        for name in 'abcde':
+            (tmp_path / name).write_text(name * 10)
+            cache.read(str(tmp_path / name))
+        assert list(cache._entries) == [str(tmp_path / 'b'), str(tmp_path / 'c'), str(tmp_path / 'd'), str(tmp_path / 'e')]
+        assert cache._bytes == 40
+
 class TestCircuitBreaker:
     """Test circuit breaker functionality."""
     
@@ -219,5 +745,257 @@ class TestCircuitBreaker:
         assert cb.state == 'OPEN'
         assert cb.failure_count == 2
 
+    def test_circuit_breaker_counts_consecutive_failures(self):
+        """Test that a success resets the count and a named breaker reports its state."""
+        import prometheus_client
+        from app import CircuitBreaker
+        
+        def failing_function():
+            raise Exception("Test failure")
+        
+        cb = CircuitBreaker(failure_threshold=2, name='test/model')
+        with pytest.raises(Exception):
+            cb.call(failing_function)
+        assert cb.call(lambda: 'ok') == 'ok'
+        assert cb.failure_count == 0
+        
+        for _ in range(2):
+            with pytest.raises(Exception):
+                cb.call(failing_function)
+        assert cb.state == 'OPEN'
+        value = prometheus_client.REGISTRY.get_sample_value('ai_assistant_circuit_breaker_state', {'model': 'test/model'})
+        assert value == 2
+
+class TestUnifiedDiff:
+    """Test the prefix/suffix-trimming unified diff used by the previews."""
+    
+    def test_matches_difflib_for_single_edit(self):
+        """Test that a small edit produces the same hunks as difflib."""
+        import difflib
+        from app import unified_diff
+        original = [f'line {i}' for i in range(50)]
+        edited = original[:20] + ['inserted'] + original[20:30] + original[31:]
+        
+        expected = list(difflib.unified_diff(original, edited, 'a', 'b', lineterm=''))
+        assert list(unified_diff(original, edited, 'a', 'b')) == expected
+    
+    def test_identical_and_empty_inputs(self):
+        """Test that identical inputs yield no diff and an empty side still diffs."""
+        from app import unified_diff
+        assert list(unified_diff(['x', 'y'], ['x', 'y'])) == []
+        assert list(unified_diff([], ['x'], 'a', 'b')) == ['--- a', '+++ b', '@@ -0,0 +1 @@', '+x']
+
+    def test_uses_native_diff_when_available(self, monkeypatch):
+        """Test that computed diffs go to difflib_rs when it is installed, and known opcodes do not."""
+        import difflib
+        import app as app_module
+        calls = []
+        
+        def native(*args, **kwargs):
+            calls.append(args)
+            return difflib.unified_diff(*args, **kwargs)
+        
+        monkeypatch.setattr(app_module, '_rs_unified_diff', native)
+        assert list(app_module.unified_diff(['x'], ['y'], 'a', 'b')) == ['--- a', '+++ b', '@@ -1 +1 @@', '-x', '+y']
+        assert len(calls) == 1
+        list(app_module.unified_diff(['x'], ['y'], opcodes=[('replace', 0, 1, 0, 1)]))
+        assert len(calls) == 1
+
+    def test_patience_matcher_for_large_changes(self, monkeypatch):
+        """Test that only a changed region past PATIENCE_MIN_LINES goes to the patience matcher."""
+        import difflib
+        import app as app_module
+        sizes = []
+        
+        class RecordingMatcher(difflib.SequenceMatcher):
+            def __init__(self, isjunk, a, b):
+                sizes.append((len(a), len(b)))
+                super().__init__(isjunk, a, b)
+        
+        monkeypatch.setattr(app_module, '_PatienceMatcher', RecordingMatcher)
+        monkeypatch.setattr(app_module, '_rs_unified_diff', None)
+        small = [f'line {i}' for i in range(1000)]
+        list(app_module.unified_diff(small, small[:500] + ['edit'] + small[501:]))
+        assert sizes == []
+        
+        large = [f'new {i}' for i in range(600)]
+        app_module._diff_opcodes(small, small[:100] + large + small[700:])
+        assert sizes == [(600, 600)]
+
+class TestModelHedging:
+    """Test hedged fallback across models."""
+    
+    @pytest.fixture
+    def assistant(self, monkeypatch):
+        import app as app_module
+        from app import EnhancedAIAssistant
+        monkeypatch.setenv('OPENROUTER_API_KEY', 'test-key')
+        assistant = EnhancedAIAssistant()
+        assistant.rate_limiter.reserve = lambda cost=1: 0
+        assistant.active_model_list = ['slow', 'fast']
+        assistant.hedge_delay = 0.05
+        return assistant, app_module
+    
+    def test_slow_model_is_hedged(self, assistant, monkeypatch):
+        """Test that a second model is raced when the first is slow, and the winner returned."""
+        assistant, app_module = assistant
+        
+        class FakeResponse:
+            status_code = 200
+            def __init__(self, model):
+                self.model = model
+                self.closed = False
+            def close(self):
+                self.closed = True
+        
+        def fake_post(url, json=None, **kwargs):
+            if json['model'] == 'slow':
+                time.sleep(0.5)
+            return FakeResponse(json['model'])
+        
+        monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+        start = time.monotonic()
+        response, error = assistant._execute_model_call('test', assistant.get_session('hedge'))
+        
+        assert error is None
+        assert response.model == 'fast'
+        assert time.monotonic() - start < 0.4
+    
+    def test_breakers_are_per_model(self, assistant, monkeypatch):
+        """Test that failures of one model do not open the breaker of another."""
+        assistant, app_module = assistant
+        
+        def fake_post(url, json=None, **kwargs):
+            raise ConnectionError(json['model'])
+        
+        monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+        assistant.active_model_list = ['broken']
+        for _ in range(5):
+            assistant._execute_model_call('test', assistant.get_session('hedge'))
+        
+        assert assistant._breaker('broken').state == 'OPEN'
+        assert assistant._breaker('fast').state == 'CLOSED'
+    
+    def test_transient_errors_are_retried(self, assistant, monkeypatch):
+        """Test that 503s are retried on the same model while a 400 falls through at once."""
+        assistant, app_module = assistant
+        monkeypatch.setattr(app_module, 'MODEL_RETRY_BACKOFF_BASE', 0.001)
+        statuses = {'slow': [503, 503, 200], 'fast': [400]}
+        calls = []
+        
+        class FakeResponse:
+            headers = {}
+            text = ''
+            def __init__(self, model):
+                self.model = model
+                self.status_code = statuses[model].pop(0)
+            def close(self):
+                pass
+        
+        def fake_post(url, json=None, **kwargs):
+            calls.append(json['model'])
+            return FakeResponse(json['model'])
+        
+        monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+        assistant.hedge_delay = 5
+        response, error = assistant._execute_model_call('test', assistant.get_session('retry'))
+        assert error is None and response.model == 'slow'
+        assert calls == ['slow', 'slow', 'slow']
+        
+        assistant.active_model_list = ['fast']
+        assert assistant._execute_model_call('test', assistant.get_session('retry')) == (None, "All models failed")
+        assert calls[3:] == ['fast']
+    
+    def test_retry_after_is_honoured_within_cap(self):
+        """Test that Retry-After sets a floor on the delay and a long one stops retrying."""
+        from app import _retry_delay, MODEL_RETRY_BACKOFF_CAP
+        assert _retry_delay(1, '2') >= 2
+        assert _retry_delay(1, str(MODEL_RETRY_BACKOFF_CAP + 1)) is None
+        assert 0 <= _retry_delay(3) <= 2
+
+class TestTokenBucket:
+    """Test model-call rate limiting."""
+    
+    def test_local_bucket_allows_burst_then_waits(self):
+        """Test that the in-process fallback allows a burst and then spaces out calls."""
+        from app import TokenBucket
+        bucket = TokenBucket('test-bucket', capacity=2, refill_per_second=1.0)
+        
+        assert bucket._reserve_local(1) == 0
+        assert bucket._reserve_local(1) == 0
+        assert 0.9 < bucket._reserve_local(1) <= 1.0
+        bucket._reserve_local(-1)
+        assert 0.9 < bucket._reserve_local(1) <= 1.0
+    
+    def test_long_wait_is_refused_and_refunded(self, monkeypatch):
+        """Test that a reservation past the max wait fails fast and gives its token back."""
+        import app as app_module
+        assistant = app_module.EnhancedAIAssistant()
+        reservations = []
+        assistant.rate_limiter.reserve = lambda cost=1: reservations.append(cost) or 3600
+        monkeypatch.setattr(app_module, 'MODEL_RATE_LIMIT_MAX_WAIT', 30)
+        
+        response, error = assistant._execute_model_call('req', app_module.ConversationState('limited'))
+        assert response is None and error.startswith('Rate limit exceeded')
+        assert reservations == [1, -1]
+
+class TestMetricsBuffer:
+    """Test batched metric mirroring."""
+    
+    def test_failed_flush_keeps_deltas(self, monkeypatch):
+        """Test that deltas survive a Redis outage and are retried on the next flush."""
+        import redis
+        import app as app_module
+        
+        def broken_pipeline(*args, **kwargs):
+            raise redis.ConnectionError("down")
+        
+        monkeypatch.setattr(app_module.redis_client, 'pipeline', broken_pipeline)
+        buffer = app_module.MetricsBuffer(flush_interval=3600)
+        buffer.inc(app_module.TOOL_CALL_SUCCESS, tool_name='read_file', status='success')
+        buffer.inc(app_module.TOOL_CALL_SUCCESS, tool_name='read_file', status='success')
+        buffer.flush()
+        
+        field = 'ai_assistant_tool_calls_total{tool_name="read_file",status="success"}'
+        assert buffer._pending == {field: 2}
+
+class TestSessionState:
+    """Test per-session conversation state."""
+    
+    def test_sessions_are_isolated(self):
+        """Test that history appended in one session is not visible in another."""
+        from app import EnhancedAIAssistant
+        assistant = EnhancedAIAssistant()
+        
+        first = assistant.get_session('session-a')
+        first.messages.append({'role': 'user', 'content': 'Hello'})
+        
+        assert assistant.get_session('session-a') is first
+        assert assistant.get_session('session-b').messages == []
+    
+    def test_session_store_evicts_least_recent(self):
+        """Test that the session cache stays bounded and keeps recently used sessions."""
+        from app import SessionStore
+        store = SessionStore(capacity=2)
+        a = store.get('lru-a')
+        store.get('lru-b')
+        assert store.get('lru-a') is a
+        store.get('lru-c')
+        
+        assert len(store) == 2
+        assert 'lru-a' in store and 'lru-b' not in store
+    
+    def test_session_header_routes_chat(self, monkeypatch):
+        """Test that the X-Session-ID header selects the conversation."""
+        import app as app_module
+        seen = []
+        monkeypatch.setattr(app_module, 'process_user_message',
+                            lambda text, request_id, session_id: seen.append(session_id) or {'reply': 'ok'})
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            client.post('/api/chat', json={'message': 'Hi'}, headers={'X-Session-ID': 'abc'})
+            client.post('/api/chat', json={'message': 'Hi'})
+        assert seen == ['abc', 'default']
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
@@ -1,6 +1,7 @@
 import pytest
 import json
-from app import EnhancedAIAssistant
+import os
+from app import EnhancedAIAssistant, ToolCallScanner, iter_stream_content
 
 class TestJSONParsing:
     """Test JSON parsing and repair functionality."""
@@ -70,6 +71,47 @@ class TestJSONParsing:
         assert "```json" in fenced_content
         assert "tool_call" in fenced_content
     
+    def test_streamed_fence_detection(self):
+        """Test that a tool call split across deltas, fences included, is still found."""
+        reply = 'Sure.\n```json\n{"tool_call": {"name": "list_files", "arguments": {}}}\n```\nDone.'
+        for size in (1, 2, 5, len(reply)):
+            scanner = ToolCallScanner()
+            for i in range(0, len(reply), size):
+                scanner.feed(reply[i:i + size])
+            assert scanner.done
+            assert scanner.tool_call == {"name": "list_files", "arguments": {}}
+
+    def test_streamed_fence_without_tool_call(self):
+        """Test that plain text and non tool-call fences yield nothing."""
+        scanner = ToolCallScanner()
+        scanner.feed('No tools needed here.')
+        assert not scanner.done and scanner.tool_call is None
+        scanner.feed('```json\n{"answer": 42}\n```')
+        assert scanner.done and scanner.tool_call is None
+    
+    def test_stream_content_parses_bytes(self):
+        """Test that SSE lines split across network chunks are parsed, skipping bad ones and stopping at [DONE]."""
+        body = b"".join([
+            'data: {"choices": [{"delta": {"content": "h\u00e9"}}]}\r\n'.encode('utf-8'),
+            b'\n',
+            b'data: not json\n',
+            b'data: {"choices": [{"delta": {}}]}\n',
+            b'data: {"choices": [{"delta": {"role": "assistant", "content": ""}}]}\n',
+            b'data: {"error": {"message": "upstream"}}\n',
+            b'data: [1, 2]\n',
+            b'data: [DONE]\n',
+            b'data: {"choices": [{"delta": {"content": "late"}}]}\n',
+        ])
+        
+        class FakeResponse:
+            def __init__(self, size):
+                self.size = size
+            def iter_content(self, chunk_size=None):
+                return (body[i:i + self.size] for i in range(0, len(body), self.size))
+        
+        for size in (1, 7, len(body)):
+            assert list(iter_stream_content(FakeResponse(size))) == ['h\u00e9']
+    
     def test_unfenced_json_extraction(self):
         """Test extraction of JSON without code fences."""
         unfenced_content = '''
@@ -89,6 +131,19 @@ class TestJSONParsing:
         assert "tool_call" in unfenced_content
         assert "list_files" in unfenced_content
     
+    def test_unfenced_tool_call_after_stream(self):
+        """Test that an unfenced tool call is found once the reply ends, braces in strings included."""
+        reply = 'Calling it now: {"tool_call": {"name": "write_file", "arguments": {"filename": "a.txt", "content": "} \\" {"}}} ok'
+        scanner = ToolCallScanner()
+        scanner.feed(reply)
+        scanner.finish(reply)
+        assert scanner.tool_call == {"name": "write_file", "arguments": {"filename": "a.txt", "content": '} " {'}}
+
+        for text in ('Just {"answer": 42}', 'Broken {"tool_call": {"name": "x"', 'Say "tool_call" plainly'):
+            scanner = ToolCallScanner()
+            scanner.finish(text)
+            assert scanner.done and scanner.tool_call is None
+
     def test_tool_argument_validation(self):
         """Test validation of tool arguments."""
         valid_args = {
@@ -169,6 +224,110 @@ class TestToolValidation:
         for tool_name, required_args in tools_with_required_args.items():
             assert tool_name in self.assistant.available_functions
             # In a real implementation, we'd validate the schema
+    
+    def test_search_files_invalid_pattern(self):
+        """Test that an invalid regex is reported instead of silently matching nothing."""
+        result = self.assistant.search_files('foo(', directory='tests')
+        assert result.startswith("Error: Invalid search pattern")
+
+    def test_search_files_ripgrep_and_fallback(self, tmp_path, monkeypatch):
+        """Test that rg output is reported sorted and a failed rg run falls back to the Python scan."""
+        import app as app_module
+        (tmp_path / 'a.py').write_text('needle')
+        (tmp_path / 'b.txt').write_text('NEEDLE')
+        fake_rg = tmp_path / 'rg'
+        monkeypatch.setattr(app_module, 'RG_BINARY', str(fake_rg))
+        
+        fake_rg.write_text("#!/bin/sh\nprintf 'z.py\\0a.py\\0'\n")
+        fake_rg.chmod(0o755)
+        assert self.assistant.search_files('needle', str(tmp_path)) == "Search results:\nFound in a.py\nFound in z.py"
+        
+        fake_rg.write_text("#!/bin/sh\nexit 2\n")
+        result = self.assistant.search_files('needle', str(tmp_path), file_pattern='*.py')
+        assert result == f"Search results:\nFound in {tmp_path / 'a.py'}"
+    
+    def test_search_fallback_skips_junk_dirs_and_binaries(self, tmp_path, monkeypatch):
+        """Test that the Python scan prunes VCS/dependency trees and NUL-containing files."""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'RG_BINARY', None)
+        (tmp_path / 'src' / 'node_modules').mkdir(parents=True)
+        (tmp_path / '.git').mkdir()
+        (tmp_path / 'src' / 'hit.py').write_text('needle')
+        (tmp_path / 'src' / 'node_modules' / 'dep.js').write_text('needle')
+        (tmp_path / '.git' / 'config').write_text('needle')
+        (tmp_path / 'blob.bin').write_bytes(b'needle\0')
+        
+        result = self.assistant.search_files('needle', str(tmp_path))
+        assert result == f"Search results:\nFound in {tmp_path / 'src' / 'hit.py'}"
+    
+    def test_run_command_allowlist_uses_executable(self):
+        """Test that allowlisted names inside arguments or chained commands are rejected."""
+        for command in ("echo pip", "rm -rf x; ls", "", "./ls", "/tmp/bin/git status"):
+            assert self.assistant.run_command(command) == "Error: Command not allowed for security reasons."
+        assert self.assistant.run_command("ls tests").startswith("Command executed successfully")
+        # Reads from /dev/null instead of waiting on the worker's stdin
+        assert self.assistant.run_command("cat") == "Command executed successfully:\n"
+
+    def test_insert_at_line_matches_indentation(self, tmp_path):
+        """Test that inserted lines take the indentation of the line they are inserted before."""
+        target = tmp_path / 'sample.py'
+        target.write_text("def f():\n\treturn 1\n")
+        self.assistant.insert_at_line(str(target), "x = 1\ny = 2", 2)
+        assert target.read_text() == "def f():\n\tx = 1\n\ty = 2\n\treturn 1\n"
+
+    def test_replace_code_in_place(self, tmp_path):
+        """Test that a shorter replacement truncates the file and CRLF endings are kept."""
+        target = tmp_path / 'sample.py'
+        target.write_bytes(b"x = 'a long value'\r\ny = 2\r\n")
+        result = self.assistant.replace_code(str(target), "x = 'a long value'\ny = 2", "x = 1\ny = 2")
+        assert result.startswith("Successfully")
+        assert target.read_bytes() == b"x = 1\r\ny = 2\r\n"
+    
+    def test_write_file_backup_keeps_old_content(self, tmp_path, monkeypatch):
+        """Test that the hardlinked backup is not changed by the overwrite that follows it."""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'BACKUP_DIR', str(tmp_path / 'backups'))
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'notes.txt').write_text('old')
+        self.assistant.write_file('notes.txt', 'new')
+        
+        backups = list((tmp_path / 'backups').iterdir())
+        assert (tmp_path / 'notes.txt').read_text() == 'new'
+        assert [b.read_text() for b in backups] == ['old']
+    
+    def test_unchanged_write_and_copied_backups_are_deduplicated(self, tmp_path, monkeypatch):
+        """Test that rewriting the same content is skipped and copied backups share one stored copy."""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'BACKUP_DIR', str(tmp_path / 'backups'))
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'notes.txt').write_text('same')
+        inode = os.stat(tmp_path / 'notes.txt').st_ino
+        assert self.assistant.write_file('notes.txt', 'same').startswith("Successfully")
+        assert os.stat(tmp_path / 'notes.txt').st_ino == inode
+        assert not (tmp_path / 'backups').exists() or not list((tmp_path / 'backups').iterdir())
+        
+        os.makedirs(tmp_path / 'backups', exist_ok=True)
+        self.assistant._copy_backup('notes.txt', str(tmp_path / 'backups' / 'a.bak'))
+        self.assistant._copy_backup('notes.txt', str(tmp_path / 'backups' / 'b.bak'))
+        objects = list((tmp_path / 'backups' / '.objects').iterdir())
+        assert len(objects) == 1
+        assert (tmp_path / 'backups' / 'a.bak').read_text() == 'same'
+        assert os.path.samefile(tmp_path / 'backups' / 'a.bak', tmp_path / 'backups' / 'b.bak')
+    
+    def test_delete_file_moves_into_backups(self, tmp_path, monkeypatch):
+        """Test that a deleted file ends up as its backup and directories are refused."""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'BACKUP_DIR', str(tmp_path / 'backups'))
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'notes.txt').write_text('old')
+        (tmp_path / 'folder').mkdir()
+        
+        assert self.assistant.delete_file('notes.txt').startswith("Successfully")
+        assert not (tmp_path / 'notes.txt').exists()
+        assert [b.read_text() for b in (tmp_path / 'backups').iterdir()] == ['old']
+        assert self.assistant.delete_file('folder').startswith("Error")
+        assert (tmp_path / 'folder').is_dir()
+        assert self.assistant.delete_file('missing.txt').startswith("Error: File")
 
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file